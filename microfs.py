@@ -10,21 +10,21 @@ You may:
 * put - copy a named local file onto the device a la equivalent FTP command.
 * get - copy a named file from the device to the local file system a la FTP.
 """
-from __future__ import print_function
 import ast
-import argparse
+import base64
+import contextlib
+import itertools
 import sys
 import os
+import re
+import shlex
 import time
 import os.path
 from serial.tools.list_ports import comports as list_serial_ports
-from serial import Serial
+from serial import Serial, SerialTimeoutException
 
 
-PY2 = sys.version_info < (3,)
-
-
-__all__ = ["ls", "rm", "put", "get", "get_serial"]
+__all__ = ["ls", "ls_detailed", "rm", "put", "put_many", "get", "get_serial"]
 
 
 #: The help text to be shown when requested.
@@ -34,8 +34,10 @@ You may use the following commands:
 
 'ls' - list files on the device (based on the equivalent Unix command);
 'rm' - remove a named file on the device (based on the Unix command);
-'put' - copy a named local file onto the device just like the FTP command; and,
-'get' - copy a named file from the device to the local file system a la FTP.
+'put' - copy a named local file onto the device just like the FTP command;
+'get' - copy a named file from the device to the local file system a la FTP;
+and, 'batch' - run several of the above commands, one per line of a file (or
+stdin), over a single connection to the device.
 
 For example, 'ufs ls' will list the files on a connected BBC micro:bit.
 """
@@ -43,6 +45,113 @@ For example, 'ufs ls' will list the files on a connected BBC micro:bit.
 
 COMMAND_LINE_FLAG = False  # Indicates running from the command line.
 SERIAL_BAUD_RATE = 115200
+#: Seconds to wait for the device to accept written data before giving up, on
+#: top of the time it takes to send a whole script at the connection's baud
+#: rate (see get_serial).
+SERIAL_WRITE_TIMEOUT = 1
+#: The (port, serial number) of the last micro:bit found by find_microbit.
+_PORT_CACHE = None
+#: The maximum number of bytes of script sent to the device in one go. The
+#: device compiles each script in RAM, so a long list of commands is split
+#: into several scripts of about this size.
+MAX_SCRIPT_SIZE = 1024
+#: The command line commands that talk to the device.
+_DEVICE_COMMANDS = ("ls", "rm", "put", "get")
+
+#: Sent by the device when it enters raw mode.
+_RAW_REPL_MSG = b"raw REPL; CTRL-B to exit\r\n>"
+#: Sent by the device when it soft resets.
+_SOFT_REBOOT_MSG = b"soft reboot\r\n"
+#: Sent by the device (in raw mode) when it has finished evaluating a script.
+_RAW_PROMPT = b"\x04>"
+#: Finds the last complete line of stderr, which holds the error message at
+#: the end of a MicroPython traceback.
+_ERROR_LINE_RE = re.compile(r"([^\r\n]*)\r\n[^\r\n]*\Z")
+
+#: Prints the name of each file on the device, one per line.
+_LS_COMMANDS = ("import os", "for n in os.listdir():\n print(n)")
+#: Prints the size and name of each file on the device, one file per line.
+#: Not every port has os.size, so fall back to os.stat if needed.
+_LS_DETAILED_COMMANDS = (
+    "import os",
+    "\n".join(
+        [
+            "try:",
+            " s = os.size",
+            "except AttributeError:",
+            " s = lambda n: os.stat(n)[6]",
+        ]
+    ),
+    "for n in os.listdir():\n print(s(n), n)",
+)
+#: Prints the version information for MicroPython on the device.
+_VERSION_COMMANDS = ("import os", "print(os.uname())")
+#: Binds u to whatever the device can write the content of a file out on.
+#: Format it with the baud rate of the connection to the device.
+_UART_INIT = "\n".join(
+    [
+        "try:",
+        " from microbit import uart as u",
+        "except ImportError:",
+        " try:",
+        "  from machine import UART",
+        "  u = UART(0, {})",
+        " except Exception:",
+        "  try:",
+        "   from sys import stdout as u",
+        "  except Exception:",
+        "   raise Exception('Could not find UART module in device.')",
+    ]
+)
+#: Prints whether the device has a base64 decoder for put to use.
+_BASE64_PROBE = (
+    "\n".join(
+        [
+            "try:",
+            " import binascii",
+            "except ImportError:",
+            " try:",
+            "  import ubinascii as binascii",
+            " except ImportError:",
+            "  binascii = None",
+        ]
+    ),
+    "print(hasattr(binascii, 'a2b_base64'))",
+)
+#: Binds a to the device's base64 decoder.
+_A2B_IMPORT = "\n".join(
+    [
+        "try:",
+        " from binascii import a2b_base64 as a",
+        "except ImportError:",
+        " from ubinascii import a2b_base64 as a",
+    ]
+)
+#: Binds e to the device's base64 encoder, or to None if it hasn't one (like
+#: the micro:bit V1).
+_B2A_IMPORT = "\n".join(
+    [
+        "try:",
+        " from binascii import b2a_base64 as e",
+        "except ImportError:",
+        " try:",
+        "  from ubinascii import b2a_base64 as e",
+        " except ImportError:",
+        "  e = None",
+    ]
+)
+#: Writes the file opened by get out as one line of base64 per chunk read.
+#: Bigger chunks mean fewer writes (and lines to decode), while 256 bytes is
+#: still small enough for the RAM on a micro:bit V1. Without a base64 encoder
+#: each (smaller) chunk is written as a bytes literal instead.
+_GET_READ_LOOP = "\n".join(
+    [
+        "while result:",
+        " result = r(256 if e else 32)",
+        " if result:",
+        "  u.write(e(result) if e else repr(result) + '\\n')",
+    ]
+)
 
 
 def find_microbit():
@@ -50,11 +159,21 @@ def find_microbit():
     Returns a tuple representation of the port and serial number for a
     connected micro:bit device. If no device is connected the tuple will be
     (None, None).
+
+    Scanning the serial ports is slow, so the result is remembered for as long
+    as the device's port still exists. A different device plugged into the
+    same port isn't detected, so the remembered port is forgotten whenever
+    opening it (see get_serial) or putting the device into raw mode (see
+    raw_on) fails, and the next call scans the ports again.
     """
+    global _PORT_CACHE
+    if _PORT_CACHE is not None and os.path.exists(_PORT_CACHE[0]):
+        return _PORT_CACHE
     ports = list_serial_ports()
     for port in ports:
         if "VID:PID=0D28:0204" in port[2].upper():
-            return (port[0], port.serial_number)
+            _PORT_CACHE = (port[0], port.serial_number)
+            return _PORT_CACHE
     return (None, None)
 
 
@@ -65,39 +184,39 @@ def raw_on(serial):
 
     def flush_to_msg(serial, msg):
         """Read the rx serial data until we reach an expected message."""
+        global _PORT_CACHE
         data = serial.read_until(msg)
         if not data.endswith(msg):
             if COMMAND_LINE_FLAG:
                 print(data)
+            # Whatever is on the port isn't a working micro:bit any more.
+            _PORT_CACHE = None
             raise IOError("Could not enter raw REPL.")
 
     def flush(serial):
         """Flush all rx input without relying on serial.flushInput()."""
-        n = serial.inWaiting()
-        while n > 0:
-            serial.read(n)
-            n = serial.inWaiting()
-
-    raw_repl_msg = b"raw REPL; CTRL-B to exit\r\n>"
-    # Send CTRL-B to end raw mode if required.
-    serial.write(b"\x02")
-    # Send CTRL-C three times between pauses to break out of loop.
-    for i in range(3):
-        serial.write(b"\r\x03")
+        avail = serial.in_waiting
+        if avail:
+            serial.read(avail)
+
+    # Send CTRL-B to end raw mode if required, in the same write as the first
+    # of three CTRL-Cs (sent between pauses) to break out of any loop.
+    for interrupt in (b"\x02\r\x03", b"\r\x03", b"\r\x03"):
+        serial.write(interrupt)
         time.sleep(0.01)
     flush(serial)
     # Go into raw mode with CTRL-A.
     serial.write(b"\r\x01")
-    flush_to_msg(serial, raw_repl_msg)
+    flush_to_msg(serial, _RAW_REPL_MSG)
     # Soft Reset with CTRL-D
     serial.write(b"\x04")
-    flush_to_msg(serial, b"soft reboot\r\n")
+    flush_to_msg(serial, _SOFT_REBOOT_MSG)
     # Some MicroPython versions/ports/forks provide a different message after
     # a Soft Reset, check if we are in raw REPL, if not send a CTRL-A again
-    data = serial.read_until(raw_repl_msg)
-    if not data.endswith(raw_repl_msg):
+    data = serial.read_until(_RAW_REPL_MSG)
+    if not data.endswith(_RAW_REPL_MSG):
         serial.write(b"\r\x01")
-        flush_to_msg(serial, raw_repl_msg)
+        flush_to_msg(serial, _RAW_REPL_MSG)
     flush(serial)
 
 
@@ -108,18 +227,173 @@ def raw_off(serial):
     serial.write(b"\x02")  # Send CTRL-B to get out of raw mode.
 
 
-def get_serial():
+def get_serial(baudrate=SERIAL_BAUD_RATE):
     """
     Detect if a micro:bit is connected and return a serial object to talk to
     it.
+
+    The baud rate defaults to the 115200 used by the REPL on the micro:bit.
+    Devices whose firmware runs the REPL at a faster rate may be given that
+    rate instead.
     """
+    global _PORT_CACHE
     port, serial_number = find_microbit()
     if port is None:
         raise IOError("Could not find micro:bit.")
-    return Serial(port, SERIAL_BAUD_RATE, timeout=1, parity="N")
+    # Each bit takes 1/baudrate seconds to send, and there are 10 bits (with
+    # the start and stop bits) per byte. So at slow baud rates, sending a
+    # whole script takes longer than SERIAL_WRITE_TIMEOUT on its own.
+    write_timeout = SERIAL_WRITE_TIMEOUT + MAX_SCRIPT_SIZE * 10 / baudrate
+    try:
+        return Serial(
+            port,
+            baudrate,
+            timeout=1,
+            write_timeout=write_timeout,
+            parity="N",
+        )
+    except IOError:
+        # The port has gone, or is now something else, so look again next
+        # time (see find_microbit).
+        _PORT_CACHE = None
+        raise
+
+
+def read_until(serial, terminator):
+    """
+    Read from the serial connection until the terminator is received or the
+    connection times out, returning the bytes read.
 
+    Unlike PySerial's own read_until, which reads a single byte at a time,
+    whatever is already waiting is read in one go. The device sends nothing
+    after the terminator, so no data is lost by over-reading.
+    """
+    data = bytearray()
+    while not data.endswith(terminator):
+        chunk = serial.read(max(1, serial.in_waiting))
+        if not chunk:
+            break  # Timed out.
+        data.extend(chunk)
+    return bytes(data)
+
+
+def batch_commands(commands):
+    """
+    Join the commands into as few newline separated scripts as possible, each
+    no longer than MAX_SCRIPT_SIZE bytes (unless a single command is longer
+    than that on its own).
+
+    Yields the encoded scripts in the order the commands were given.
+    """
+    batch = []
+    size = 0
+    for command in commands:
+        command_bytes = command.encode("utf-8")
+        if batch and size + len(command_bytes) > MAX_SCRIPT_SIZE:
+            yield b"\n".join(batch)
+            batch = []
+            size = 0
+        batch.append(command_bytes)
+        size += len(command_bytes) + 1
+    if batch:
+        yield b"\n".join(batch)
 
-def execute(commands, serial=None):
+
+def enter_raw_paste(serial):
+    """
+    Ask the device, in raw mode, to take the next script in raw-paste mode.
+    Here the device tells the host when it has room for more of the script,
+    so the host never sends more than it can buffer.
+
+    Returns the number of bytes the device takes at a time, or 0 if it
+    doesn't support raw-paste mode (MicroPython before v1.14, including the
+    firmware on the micro:bit V1).
+    """
+    serial.write(b"\x05A\x01")
+    reply = serial.read(2)
+    if reply == b"R\x00":
+        return 0  # Understood, but raw-paste mode isn't enabled.
+    if reply == b"R\x01":
+        window = serial.read(2)
+        if len(window) == 2:
+            return int.from_bytes(window, "little")
+    else:
+        # Older firmware doesn't understand the request and just restarts raw
+        # mode, because of the CTRL-A at the end of it.
+        rest = read_until(serial, _RAW_REPL_MSG[len(reply) :])
+        if reply + rest == _RAW_REPL_MSG:
+            return 0
+    raise IOError("Could not enter raw REPL.")
+
+
+def write_raw_paste(serial, script, window):
+    """
+    Write the script, and the CTRL-D that ends it, to a device in raw-paste
+    mode (see enter_raw_paste). No more than window bytes are sent until the
+    device says it has room for more.
+    """
+    room = window
+    sent = 0
+    while sent < len(script):
+        # The device sends CTRL-A each time it has room for another window of
+        # data, or CTRL-D if it's given up on the script.
+        while not room or serial.in_waiting:
+            if serial.read(1) != b"\x01":
+                raise IOError("The device stopped accepting data.")
+            room += window
+        chunk = script[sent : sent + room]
+        serial.write(chunk)
+        room -= len(chunk)
+        sent += len(chunk)
+    serial.write(b"\x04")
+    # The device acknowledges the end of the script with a CTRL-D of its own,
+    # after any CTRL-As still on their way.
+    if not serial.read_until(b"\x04").endswith(b"\x04"):
+        raise IOError("The device stopped accepting data.")
+
+
+def write_paced(serial, script):
+    """
+    Write the script, and the CTRL-D that ends it, to a device without
+    raw-paste mode. There's no flow control, so the script is sent in small
+    chunks with a pause after each, giving the device time to keep up.
+    """
+    for i in range(0, len(script), 32):
+        serial.write(script[i : i + 32])
+        time.sleep(0.01)
+    serial.write(b"\x04")
+
+
+@contextlib.contextmanager
+def raw_session(serial=None, in_raw_mode=False):
+    """
+    A context manager that yields a serial connection to the device in raw
+    mode, so several calls to execute (with in_raw_mode=True) can share it.
+
+    If no serial connection is provided, one is opened (see get_serial) and
+    closed again afterwards. If in_raw_mode is True the device has already
+    been put into raw mode (see raw_on), so the handshake is skipped and the
+    device is left in raw mode.
+    """
+    close_serial = serial is None
+    if close_serial:
+        serial = get_serial()
+    try:
+        # No pauses are needed around opening the connection or raw mode:
+        # raw_on and the reads in execute block until the device has sent
+        # the expected prompt.
+        if not in_raw_mode:
+            raw_on(serial)
+        yield serial
+        if not in_raw_mode:
+            raw_off(serial)
+    finally:
+        # Don't leave a connection opened here open if anything goes wrong.
+        if close_serial:
+            serial.close()
+
+
+def execute(commands, serial=None, in_raw_mode=False):
     """
     Sends the command to the connected micro:bit via serial and returns the
     result. If no serial connection is provided, attempts to autodetect the
@@ -128,34 +402,46 @@ def execute(commands, serial=None):
     For this to work correctly, a particular sequence of commands needs to be
     sent to put the device into a good state to process the incoming command.
 
+    The commands are sent to the device in as few round trips as possible
+    (see batch_commands), using raw-paste mode if the device supports it
+    (see enter_raw_paste).
+
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), so the handshake is skipped and the device is left in raw
+    mode. This lets several calls share a single handshake (see
+    raw_session).
+
     Returns the stdout and stderr output from the micro:bit.
     """
-    close_serial = False
-    if serial is None:
-        serial = get_serial()
-        close_serial = True
-        time.sleep(0.1)
-    result = b""
-    raw_on(serial)
-    time.sleep(0.1)
-    # Write the actual command and send CTRL-D to evaluate.
-    for command in commands:
-        command_bytes = command.encode("utf-8")
-        for i in range(0, len(command_bytes), 32):
-            serial.write(command_bytes[i : min(i + 32, len(command_bytes))])
-            time.sleep(0.01)
-        serial.write(b"\x04")
-        response = serial.read_until(b"\x04>")  # Read until prompt.
-        out, err = response[2:-2].split(b"\x04", 1)  # Split stdout, stderr
-        result += out
-        if err:
-            return b"", err
-    time.sleep(0.1)
-    raw_off(serial)
-    if close_serial:
-        serial.close()
-        time.sleep(0.1)
-    return result, err
+    result = []
+    err = b""
+    with raw_session(serial, in_raw_mode) as serial:
+        # Each script is sent in raw-paste mode if the device has it, since
+        # then it says when it's ready for more. Otherwise (and for the rest
+        # of the scripts) fall back to writing small chunks with pauses.
+        use_raw_paste = True
+        for script in batch_commands(commands):
+            try:
+                window = enter_raw_paste(serial) if use_raw_paste else 0
+                if window:
+                    write_raw_paste(serial, script, window)
+                else:
+                    use_raw_paste = False
+                    write_paced(serial, script)
+            except SerialTimeoutException:
+                # This is already an IOError, but its message doesn't say
+                # what went wrong.
+                raise IOError("The device stopped accepting data.")
+            response = read_until(serial, _RAW_PROMPT)  # Read until prompt.
+            if not window:
+                # Outside raw-paste mode, the device says OK before running
+                # the script.
+                response = response[2:]
+            out, err = response[:-2].split(b"\x04", 1)  # Split stdout/err
+            result.append(out)
+            if err:
+                return b"", err
+    return b"".join(result), err
 
 
 def clean_error(err):
@@ -165,137 +451,214 @@ def clean_error(err):
     """
     if err:
         decoded = err.decode("utf-8")
-        try:
-            return decoded.split("\r\n")[-2]
-        except Exception:
-            return decoded
+        match = _ERROR_LINE_RE.search(decoded)
+        return match.group(1) if match else decoded
     return "There was an error."
 
 
-def ls(serial=None):
+def ls(serial=None, in_raw_mode=False):
     """
     List the files on the micro:bit.
 
     If no serial object is supplied, microfs will attempt to detect the
     connection itself.
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), and is left in it.
 
     Returns a list of the files on the connected device or raises an IOError if
     there's a problem.
     """
-    out, err = execute(
-        [
-            "import os",
-            "print(os.listdir())",
-        ],
-        serial,
-    )
+    out, err = execute(_LS_COMMANDS, serial, in_raw_mode)
+    if err:
+        raise IOError(clean_error(err))
+    # The device prints one filename per line. Split the raw bytes so only
+    # the names themselves need decoding.
+    return [name.decode("utf-8") for name in out.splitlines()]
+
+
+def ls_detailed(serial=None, in_raw_mode=False):
+    """
+    List the files on the micro:bit along with their sizes, all in a single
+    round trip to the device.
+
+    If no serial object is supplied, microfs will attempt to detect the
+    connection itself.
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), and is left in it.
+
+    Returns a list of (filename, size in bytes) tuples for the files on the
+    connected device or raises an IOError if there's a problem.
+    """
+    out, err = execute(_LS_DETAILED_COMMANDS, serial, in_raw_mode)
     if err:
         raise IOError(clean_error(err))
-    return ast.literal_eval(out.decode("utf-8"))
+    # The device prints the size and name of each file per line. The size
+    # comes first since the name may contain spaces.
+    result = []
+    for line in out.splitlines():
+        size, name = line.split(b" ", 1)
+        result.append((name.decode("utf-8"), int(size)))
+    return result
 
 
-def rm(filename, serial=None):
+def rm(filename, serial=None, in_raw_mode=False):
     """
     Removes a referenced file on the micro:bit.
 
     If no serial object is supplied, microfs will attempt to detect the
     connection itself.
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), and is left in it.
 
     Returns True for success or raises an IOError if there's a problem.
     """
-    commands = [
-        "import os",
-        "os.remove('{}')".format(filename),
-    ]
-    out, err = execute(commands, serial)
+    commands = ("import os", "os.remove('{}')".format(filename))
+    out, err = execute(commands, serial, in_raw_mode)
     if err:
         raise IOError(clean_error(err))
     return True
 
 
-def put(filename, target=None, serial=None):
+def has_base64(serial):
+    """
+    Returns True if the device, already in raw mode via the given serial
+    connection, has a base64 decoder (in binascii or ubinascii). The firmware
+    on the micro:bit V1 doesn't.
+    """
+    out, err = execute(_BASE64_PROBE, serial, True)
+    return out.strip() == b"True"
+
+
+def put_commands(filename, target, use_base64=True):
+    """
+    Yields the commands needed to copy a referenced file on the LOCAL file
+    system onto the device as the named target.
+
+    The content is sent base64 encoded, unless use_base64 is False because
+    the device can't decode it (see has_base64).
+
+    The file is read lazily, a block at a time as the commands are consumed,
+    so put and put_many never hold the whole of a file in memory and
+    put_many can batch the commands for several files into the same scripts.
+    """
+    if use_base64:
+        yield _A2B_IMPORT
+    yield "fd = open('{}', 'wb')".format(target)
+    yield "f = fd.write"
+    with open(filename, "rb") as local:
+        if use_base64:
+            # Base64 encoded lines are both shorter and quicker for the device
+            # to parse than the equivalent bytes literals. The file is
+            # streamed in large blocks, each encoded in one go and then split
+            # into lines of 96 characters (72 bytes of content) so every line
+            # decodes on its own.
+            for block in iter(lambda: local.read(72 * 64), b""):
+                encoded = base64.b64encode(block).decode("ascii")
+                for i in range(0, len(encoded), 96):
+                    yield "f(a(b'{}'))".format(encoded[i : i + 96])
+        else:
+            for block in iter(lambda: local.read(64), b""):
+                yield "f(" + repr(block) + ")"
+    yield "fd.close()"
+
+
+def put(filename, target=None, serial=None, in_raw_mode=False):
     """
     Puts a referenced file on the LOCAL file system onto the
     file system on the BBC micro:bit.
 
+    The device is first asked whether it can decode base64 (see has_base64),
+    and is sent the content of the file as bytes literals if not.
+
     If no serial object is supplied, microfs will attempt to detect the
     connection itself.
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), and is left in it.
 
     Returns True for success or raises an IOError if there's a problem.
     """
     if not os.path.isfile(filename):
         raise IOError("No such file.")
-    with open(filename, "rb") as local:
-        content = local.read()
-    filename = os.path.basename(filename)
     if target is None:
-        target = filename
-    commands = [
-        "fd = open('{}', 'wb')".format(target),
-        "f = fd.write",
-    ]
-    while content:
-        line = content[:64]
-        if PY2:
-            commands.append("f(b" + repr(line) + ")")
-        else:
-            commands.append("f(" + repr(line) + ")")
-        content = content[64:]
-    commands.append("fd.close()")
-    out, err = execute(commands, serial)
+        target = os.path.basename(filename)
+    with raw_session(serial, in_raw_mode) as serial:
+        commands = put_commands(filename, target, has_base64(serial))
+        out, err = execute(commands, serial, True)
     if err:
         raise IOError(clean_error(err))
     return True
 
 
-def get(filename, target=None, serial=None):
+def put_many(filenames, serial=None):
+    """
+    Puts several referenced files on the LOCAL file system onto the file
+    system on the BBC micro:bit, each named after the local file.
+
+    All the files are copied in a single call to execute, so the device is
+    only put into raw mode once and the scripts sent to it are batched
+    across the files. Like put, the device is first asked whether it can
+    decode base64 (see has_base64).
+
+    If no serial object is supplied, microfs will attempt to detect the
+    connection itself.
+
+    Returns True for success (including when there are no files to copy, in
+    which case the device isn't touched) or raises an IOError if there's a
+    problem.
+    """
+    if not filenames:
+        return True
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            raise IOError("No such file: {}".format(filename))
+    with raw_session(serial) as serial:
+        use_base64 = has_base64(serial)
+        commands = itertools.chain.from_iterable(
+            put_commands(filename, os.path.basename(filename), use_base64)
+            for filename in filenames
+        )
+        out, err = execute(commands, serial, True)
+    if err:
+        raise IOError(clean_error(err))
+    return True
+
+
+def get(filename, target=None, serial=None, in_raw_mode=False):
     """
     Gets a referenced file on the device's file system and copies it to the
     target (or current working directory if unspecified).
 
     If no serial object is supplied, microfs will attempt to detect the
     connection itself.
+    If in_raw_mode is True the device has already been put into raw mode
+    (see raw_on), and is left in it.
 
     Returns True for success or raises an IOError if there's a problem.
     """
     if target is None:
         target = filename
+    # A connection opened by execute uses the default baud rate.
+    baudrate = SERIAL_BAUD_RATE if serial is None else serial.baudrate
     commands = [
-        "\n".join(
-            [
-                "try:",
-                " from microbit import uart as u",
-                "except ImportError:",
-                " try:",
-                "  from machine import UART",
-                "  u = UART(0, {})".format(SERIAL_BAUD_RATE),
-                " except Exception:",
-                "  try:",
-                "   from sys import stdout as u",
-                "  except Exception:",
-                "   raise Exception('Could not find UART module in device.')",
-            ]
-        ),
+        _UART_INIT.format(baudrate),
+        _B2A_IMPORT,
         "f = open('{}', 'rb')".format(filename),
         "r = f.read",
         "result = True",
-        "\n".join(
-            [
-                "while result:",
-                " result = r(32)",
-                " if result:",
-                "  u.write(repr(result))",
-            ]
-        ),
+        _GET_READ_LOOP,
         "f.close()",
     ]
-    out, err = execute(commands, serial)
+    out, err = execute(commands, serial, in_raw_mode)
     if err:
         raise IOError(clean_error(err))
-    # Recombine the bytes while removing "b'" from start and "'" from end.
-    assert out.startswith(b"b'")
-    assert out.endswith(b"'")
-    out = eval(b"".join(out.split(b"'b'")))
+    # Each chunk read on the device arrives as a line of base64, or as a
+    # bytes literal if the device has no base64 encoder.
+    if out[:2] in (b"b'", b'b"'):
+        out = b"".join(
+            ast.literal_eval(line.decode("ascii")) for line in out.splitlines()
+        )
+    else:
+        out = b"".join(base64.b64decode(line) for line in out.split())
     with open(target, "wb") as f:
         f.write(out)
     return True
@@ -313,13 +676,7 @@ def version(serial=None):
     there was a problem parsing the output.
     """
     try:
-        out, err = execute(
-            [
-                "import os",
-                "print(os.uname())",
-            ],
-            serial,
-        )
+        out, err = execute(_VERSION_COMMANDS, serial)
         if err:
             raise ValueError(clean_error(err))
     except ValueError:
@@ -341,6 +698,55 @@ def version(serial=None):
     return result
 
 
+def check_filename(args):
+    """
+    Given the parsed arguments for an rm, put or get command, ensure a
+    filename was provided. If not, print an error message and exit.
+    """
+    if args.command != "ls" and not args.path:
+        print(
+            '{0}: missing filename. (e.g. "ufs {0} foo.txt")'.format(
+                args.command
+            )
+        )
+        sys.exit(2)
+
+
+def split_command(line):
+    """
+    Split a line of a batch file into its arguments, much as a POSIX shell
+    would, so names containing spaces can be quoted. Unlike shlex.split, a
+    backslash is just another character rather than an escape, so Windows
+    paths such as C:\\Users\\me\\main.py come through unchanged.
+    """
+    lexer = shlex.shlex(line, posix=True)
+    lexer.whitespace_split = True
+    lexer.escape = ""
+    lexer.commenters = ""
+    return list(lexer)
+
+
+def run_command(args, serial, in_raw_mode=False):
+    """
+    Run the ls, rm, put or get command described by the parsed arguments via
+    the given serial connection, which may already be in raw mode.
+    """
+    if args.command == "ls":
+        if args.long:
+            for name, size in ls_detailed(serial, in_raw_mode):
+                print("{:>8} {}".format(size, name))
+        else:
+            list_of_files = ls(serial, in_raw_mode)
+            if list_of_files:
+                print(args.delimiter.join(list_of_files))
+    elif args.command == "rm":
+        rm(args.path, serial, in_raw_mode)
+    elif args.command == "put":
+        put(args.path, args.target, serial, in_raw_mode)
+    elif args.command == "get":
+        get(args.path, args.target, serial, in_raw_mode)
+
+
 def main(argv=None):
     """
     Entry point for the command line tool 'ufs'.
@@ -349,6 +755,10 @@ def main(argv=None):
 
     Exceptions are caught and printed for the user.
     """
+    # Only the command line tool needs argparse, so don't make importing
+    # microfs as a module pay for it.
+    import argparse
+
     if not argv:
         argv = sys.argv[1:]
     try:
@@ -356,8 +766,18 @@ def main(argv=None):
         COMMAND_LINE_FLAG = True
 
         parser = argparse.ArgumentParser(description=_HELP_TEXT)
+        parser.add_argument(
+            "-b",
+            "--baudrate",
+            type=int,
+            default=SERIAL_BAUD_RATE,
+            help="The baud rate of the device's REPL (default is {}).".format(
+                SERIAL_BAUD_RATE
+            ),
+        )
         subparsers = parser.add_subparsers(
-            dest="command", help="One of 'ls', 'rm', 'put' or 'get'"
+            dest="command",
+            help="One of 'ls', 'rm', 'put', 'get' or 'batch'",
         )
 
         ls_parser = subparsers.add_parser("ls")
@@ -367,6 +787,12 @@ def main(argv=None):
             default=" ",
             help='Specify a delimiter string (default is whitespace). Eg. ";"',
         )
+        ls_parser.add_argument(
+            "-l",
+            "--long",
+            action="store_true",
+            help="List one file per line, with its size in bytes.",
+        )
 
         rm_parser = subparsers.add_parser("rm")
         rm_parser.add_argument(
@@ -389,29 +815,52 @@ def main(argv=None):
             "target", nargs="?", help="Specify a target filename."
         )
 
+        batch_parser = subparsers.add_parser("batch")
+        batch_parser.add_argument(
+            "path",
+            nargs="?",
+            default="-",
+            help="A file of ufs commands, one per line (default is stdin).",
+        )
+
         args = parser.parse_args(argv)
-        if args.command == "ls":
-            list_of_files = ls()
-            if list_of_files:
-                print(args.delimiter.join(list_of_files))
-        elif args.command == "rm":
-            if args.path:
-                rm(args.path)
-            else:
-                print('rm: missing filename. (e.g. "ufs rm foo.txt")')
-                sys.exit(2)
-        elif args.command == "put":
-            if args.path:
-                put(args.path, args.target)
-            else:
-                print('put: missing filename. (e.g. "ufs put foo.txt")')
-                sys.exit(2)
-        elif args.command == "get":
-            if args.path:
-                get(args.path, args.target)
+        if args.command == "batch":
+            if args.path == "-":
+                lines = sys.stdin.readlines()
             else:
-                print('get: missing filename. (e.g. "ufs get foo.txt")')
-                sys.exit(2)
+                with open(args.path) as batch_file:
+                    lines = batch_file.readlines()
+            # Check every command before touching the device.
+            batch = []
+            for line in lines:
+                words = split_command(line)
+                if not words:
+                    continue
+                if words[0].startswith("-"):
+                    # Options such as --baudrate apply to the whole batch.
+                    raise ValueError(
+                        "batch: '{}' can only be given before 'batch'.".format(
+                            words[0]
+                        )
+                    )
+                command = parser.parse_args(words)
+                if command.command not in _DEVICE_COMMANDS:
+                    raise ValueError(
+                        "batch: cannot run '{}'.".format(command.command)
+                    )
+                check_filename(command)
+                batch.append(command)
+            with get_serial(args.baudrate) as serial:
+                # Put the device into raw mode once for the whole batch,
+                # rather than once for every command in it.
+                raw_on(serial)
+                for command in batch:
+                    run_command(command, serial, True)
+                raw_off(serial)
+        elif args.command in _DEVICE_COMMANDS:
+            check_filename(args)
+            with get_serial(args.baudrate) as serial:
+                run_command(args, serial)
         else:
             # Display some help.
             parser.print_help()
@@ -37,6 +37,7 @@ setup(
         "microfs",
     ],
     license="MIT",
+    python_requires=">=3.3",
     install_requires=[
         "pyserial>=3.0.1,<4.0",
     ],
@@ -48,7 +49,6 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: POSIX",
         "Operating System :: Microsoft :: Windows",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3.3",
         "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the microfs test suite.
+"""
+import base64
+import pytest
+from unittest import mock
+
+
+#: The local file used by the tests that copy a file onto the device.
+FIXTURE_PATH = "tests/fixture_file.txt"
+
+
+@pytest.fixture(scope="session")
+def fixture_content():
+    """
+    The raw content of the fixture file, read from disk once per test run.
+    """
+    with open(FIXTURE_PATH, "rb") as fixture_file:
+        return fixture_file.read()
+
+
+@pytest.fixture(scope="session")
+def fixture_encoded(fixture_content):
+    """
+    The fixture file's content as the base64 text put sends to the device.
+    """
+    return base64.b64encode(fixture_content).decode("ascii")
+
+
+@pytest.fixture(autouse=True)
+def command_line_flag(monkeypatch):
+    """
+    Calling main sets microfs.COMMAND_LINE_FLAG for the rest of the process.
+    Restore it after every test, so results don't depend on which tests an
+    xdist worker happened to run first.
+    """
+    monkeypatch.setattr("microfs.COMMAND_LINE_FLAG", False)
+
+
+@pytest.fixture(autouse=True)
+def port_cache(monkeypatch):
+    """
+    find_microbit remembers the port it found in microfs._PORT_CACHE. Start
+    every test with an empty cache, so no test can pick up a port found by
+    another one run earlier in the same xdist worker.
+    """
+    monkeypatch.setattr("microfs._PORT_CACHE", None)
+
+
+@pytest.fixture(autouse=True)
+def mock_sleep(mocker):
+    """
+    raw_on pauses between the CTRL-Cs it sends to the device. There's no
+    device to wait for in the tests, so replace time.sleep with a mock that
+    returns at once. Returns the mock.
+    """
+    return mocker.patch("microfs.time.sleep")
+
+
+@pytest.fixture
+def mock_print(monkeypatch):
+    """
+    Replaces the built-in print function with a mock for the duration of the
+    test.
+    """
+    m = mock.Mock()
+    monkeypatch.setattr("builtins.print", m)
+    return m
+
+
+@pytest.fixture
+def execute_mock(mocker):
+    """
+    Patches microfs.execute with a mock that reports the commands ran without
+    any output or errors, unless the test says otherwise. Returns the mock.
+    """
+    return mocker.patch("microfs.execute", return_value=(b"", b""))
+
+
+#: The attributes of a serial connection that microfs makes use of.
+SERIAL_SPEC = [
+    "write",
+    "read",
+    "read_until",
+    "in_waiting",
+    "baudrate",
+    "close",
+]
+
+
+@pytest.fixture
+def mock_serial():
+    """
+    A mock serial connection limited to the attributes microfs uses, so it's
+    cheaper to build than a bare MagicMock and typos in tests fail loudly.
+    It's a plain Mock since microfs never uses the connection's magic methods
+    (the context manager is mock_serial_ctx).
+    """
+    return mock.Mock(spec=SERIAL_SPEC)
+
+
+@pytest.fixture
+def exec_serial(mock_serial):
+    """
+    Returns a function that sets mock_serial up as a device without raw-paste
+    mode, to answer each script execute sends with the given responses, in
+    order, and returns it.
+    """
+
+    def make(*responses):
+        mock_serial.in_waiting = 0
+        mock_serial.read.side_effect = [b"R\x00"] + list(responses)
+        return mock_serial
+
+    return make
+
+
+@pytest.fixture
+def raw_mode(mocker):
+    """
+    Patches raw_on and raw_off, so execute can be tested on its own. Returns
+    a dict of the mocks, keyed by name.
+    """
+    return mocker.patch.multiple(
+        "microfs", raw_on=mock.DEFAULT, raw_off=mock.DEFAULT
+    )
+
+
+@pytest.fixture
+def put_device(mock_serial, raw_mode, mocker):
+    """
+    Sets up a device for put and put_many to copy files onto: get_serial
+    returns mock_serial, raw_on and raw_off are patched, and the device says
+    it can decode base64. Returns the mock of has_base64.
+    """
+    mocker.patch("microfs.get_serial", return_value=mock_serial)
+    return mocker.patch("microfs.has_base64", return_value=True)
+
+
+@pytest.fixture
+def mock_serial_ctx(mock_serial):
+    """
+    A mock of what get_serial returns: a context manager that yields the
+    mock_serial fixture.
+    """
+    ctx = mock.MagicMock(spec=["__enter__", "__exit__"])
+    ctx.__enter__.return_value = mock_serial
+    return ctx
+
+
+@pytest.fixture
+def patch_microfs(mock_serial_ctx, mocker):
+    """
+    Patches the functions that microfs.main dispatches to, along with
+    get_serial (which returns mock_serial_ctx) and the functions that put the
+    device into and out of raw mode for a batch. Returns a dict of the mocks,
+    keyed by name.
+    """
+    mocks = mocker.patch.multiple(
+        "microfs",
+        raw_on=mock.DEFAULT,
+        raw_off=mock.DEFAULT,
+        ls=mock.DEFAULT,
+        ls_detailed=mock.DEFAULT,
+        rm=mock.DEFAULT,
+        put=mock.DEFAULT,
+        get=mock.DEFAULT,
+        get_serial=mock.DEFAULT,
+    )
+    mocks["get_serial"].return_value = mock_serial_ctx
+    return mocks
@@ -2,59 +2,201 @@
 """
 Tests for the microfs module.
 """
-import sys
-import microfs
+import ast
+import base64
+import collections
+import io
 import pytest
+from unittest import mock
 
+# Skip, rather than fail to collect, the tests if PySerial isn't installed.
+pytest.importorskip("serial")
 
-try:
-    from unittest import mock
-except ImportError:
-    import mock
+import microfs
+from microfs import (
+    batch_commands,
+    clean_error,
+    execute,
+    find_microbit,
+    get,
+    get_serial,
+    has_base64,
+    ls,
+    ls_detailed,
+    main,
+    put,
+    put_commands,
+    put_many,
+    raw_off,
+    raw_on,
+    read_until,
+    rm,
+    version,
+)
+
+
+#: Pretends to be a representation of a port in PySerial, which can be
+#: indexed like a tuple or have its serial number looked up by name.
+FakePort = collections.namedtuple(
+    "FakePort", ["device", "description", "hwid", "serial_number"]
+)
+#: How PySerial describes the port of a connected micro:bit.
+MICROBIT_PORT = FakePort(
+    "/dev/ttyACM3",
+    "MBED CMSIS-DAP",
+    "USB_CDC USB VID:PID=0D28:0204 "
+    "SER=9900023431864e45000e10050000005b00000000cc4d28bd "
+    "LOCATION=4-1.2",
+    "9900023431864e45000e10050000005b00000000cc4d28bd",
+)
+#: What the device sends when it enters raw mode and when it soft resets.
+RAW_REPL = b"raw REPL; CTRL-B to exit\r\n>"
+SOFT_REBOOT = b"soft reboot\r\n"
+#: What raw_on reads from a device that goes into raw mode without a hitch.
+RAW_ON_RESPONSES = (RAW_REPL, SOFT_REBOOT, RAW_REPL)
+#: The commands the batch_commands and execute tests send to the device, the
+#: script they're joined into and the device's response to it (stdout and
+#: stderr, each ended with CTRL-D, followed by the prompt).
+LISTDIR_COMMANDS = ("import os", "os.listdir()")
+LISTDIR_SCRIPT = b"import os\nos.listdir()"
+LISTDIR_RESPONSE = b"OK[]\x04\x04>"
+#: What the device sends to stderr when a script raises an exception.
+TRACEBACK = (
+    b"Traceback (most recent call last):\r\n "
+    b'File "<stdin>", line 2, in <module>\r\n'
+    b'File "<stdin>", line 2, in <module>\r\n'
+    b'File "<stdin>", line 2, in <module>\r\n'
+    b"OSError: file not found\r\n"
+)
+#: The commands ls is expected to send to the device.
+LS_COMMANDS = ("import os", "for n in os.listdir():\n print(n)")
+#: The import put is expected to send before the content of any file.
+PUT_IMPORT = "\n".join(
+    [
+        "try:",
+        " from binascii import a2b_base64 as a",
+        "except ImportError:",
+        " from ubinascii import a2b_base64 as a",
+    ]
+)
+#: The commands get is expected to send to fetch hello.txt from the device.
+GET_HELLO_COMMANDS = [
+    "\n".join(
+        [
+            "try:",
+            " from microbit import uart as u",
+            "except ImportError:",
+            " try:",
+            "  from machine import UART",
+            "  u = UART(0, {})".format(microfs.SERIAL_BAUD_RATE),
+            " except Exception:",
+            "  try:",
+            "   from sys import stdout as u",
+            "  except Exception:",
+            "   raise Exception('Could not find UART module in device.')",
+        ]
+    ),
+    "\n".join(
+        [
+            "try:",
+            " from binascii import b2a_base64 as e",
+            "except ImportError:",
+            " try:",
+            "  from ubinascii import b2a_base64 as e",
+            " except ImportError:",
+            "  e = None",
+        ]
+    ),
+    "f = open('hello.txt', 'rb')",
+    "r = f.read",
+    "result = True",
+    "\n".join(
+        [
+            "while result:",
+            " result = r(256 if e else 32)",
+            " if result:",
+            "  u.write(e(result) if e else repr(result) + '\\n')",
+        ]
+    ),
+    "f.close()",
+]
 
 
-if sys.version_info.major == 2:
-    import __builtin__ as builtins
-else:
-    import builtins
+def make_open_mock():
+    """
+    Returns a mock of the open function along with the file handle it
+    returns, which only supports being written to in a with block. This is all
+    get needs and is cheaper to build than mock.mock_open.
+    """
+    handle = mock.MagicMock(spec=["write", "__enter__", "__exit__"])
+    handle.__enter__.return_value = handle
+    return mock.Mock(return_value=handle), handle
 
 
-def test_find_micro_bit():
+def test_find_micro_bit(mocker):
     """
     If a micro:bit is connected (according to PySerial) return the port and
     serial number.
     """
+    mocker.patch("microfs.list_serial_ports", return_value=[MICROBIT_PORT])
+    result = find_microbit()
+    assert result == ("/dev/ttyACM3", MICROBIT_PORT.serial_number)
+    assert microfs._PORT_CACHE == result
 
-    class FakePort:
-        """
-        Pretends to be a representation of a port in PySerial.
-        """
 
-        def __init__(self, port_info, serial_number):
-            self.port_info = port_info
-            self.serial_number = serial_number
+def test_find_micro_bit_twice(mocker):
+    """
+    Once a micro:bit has been found, looking for it again while it's still
+    connected doesn't scan the serial ports a second time.
+    """
+    mock_ports = mock.Mock(return_value=[MICROBIT_PORT])
+    mocker.patch("microfs.list_serial_ports", mock_ports)
+    mocker.patch("microfs.os.path.exists", return_value=True)
+    first = find_microbit()
+    second = find_microbit()
+    assert first == second == ("/dev/ttyACM3", MICROBIT_PORT.serial_number)
+    assert mock_ports.call_count == 1
 
-        def __getitem__(self, key):
-            return self.port_info[key]
 
-    serial_number = "9900023431864e45000e10050000005b00000000cc4d28bd"
-    port_info = [
+def test_find_micro_bit_cached(mocker):
+    """
+    If the port of a previously found micro:bit still exists, return it
+    without scanning the serial ports again.
+    """
+    cached = (
         "/dev/ttyACM3",
-        "MBED CMSIS-DAP",
-        "USB_CDC USB VID:PID=0D28:0204 "
-        "SER=9900023431864e45000e10050000005b00000000cc4d28bd "
-        "LOCATION=4-1.2",
-    ]
-    port = FakePort(port_info, serial_number)
-    ports = [
-        port,
-    ]
-    with mock.patch("microfs.list_serial_ports", return_value=ports):
-        result = microfs.find_microbit()
-        assert result == ("/dev/ttyACM3", serial_number)
+        "9900023431864e45000e10050000005b00000000cc4d28bd",
+    )
+    mock_ports = mock.Mock(return_value=[])
+    mocker.patch.multiple(
+        "microfs", list_serial_ports=mock_ports, _PORT_CACHE=cached
+    )
+    mocker.patch("microfs.os.path.exists", return_value=True)
+    result = find_microbit()
+    assert result == cached
+    assert mock_ports.call_count == 0
 
 
-def test_find_micro_bit_no_device():
+def test_find_micro_bit_cached_port_gone(mocker):
+    """
+    If the port of a previously found micro:bit no longer exists, scan the
+    serial ports again.
+    """
+    cached = (
+        "/dev/ttyACM3",
+        "9900023431864e45000e10050000005b00000000cc4d28bd",
+    )
+    mock_ports = mock.Mock(return_value=[])
+    mocker.patch.multiple(
+        "microfs", list_serial_ports=mock_ports, _PORT_CACHE=cached
+    )
+    mocker.patch("microfs.os.path.exists", return_value=False)
+    result = find_microbit()
+    assert result == (None, None)
+    assert mock_ports.call_count == 1
+
+
+def test_find_micro_bit_no_device(mocker):
     """
     If there is no micro:bit connected (according to PySerial) return None.
     """
@@ -68,601 +210,836 @@ def test_find_micro_bit_no_device():
     ports = [
         port,
     ]
-    with mock.patch("microfs.list_serial_ports", return_value=ports):
-        result = microfs.find_microbit()
-        assert result == (None, None)
+    mocker.patch("microfs.list_serial_ports", return_value=ports)
+    result = find_microbit()
+    assert result == (None, None)
 
 
-def test_raw_on():
+def test_raw_on(mock_serial, mock_sleep):
     """
     Check the expected commands are sent to the device to put MicroPython into
     raw mode.
     """
-    mock_serial = mock.MagicMock()
-    mock_serial.inWaiting.return_value = 0
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"soft reboot\r\n",
-        b"raw REPL; CTRL-B to exit\r\n>",
+    in_waiting = mock.PropertyMock(return_value=0)
+    type(mock_serial).in_waiting = in_waiting
+    mock_serial.read_until.side_effect = RAW_ON_RESPONSES
+    raw_on(mock_serial)
+    assert in_waiting.call_count == 2
+    writes = [c[0][0] for c in mock_serial.write.call_args_list]
+    assert writes == [
+        b"\x02\r\x03",
+        b"\r\x03",
+        b"\r\x03",
+        b"\r\x01",
+        b"\x04",
     ]
-    mock_serial.read_until.side_effect = data
-    microfs.raw_on(mock_serial)
-    assert mock_serial.inWaiting.call_count == 2
-    assert mock_serial.write.call_count == 6
-    assert mock_serial.write.call_args_list[0][0][0] == b"\x02"
-    assert mock_serial.write.call_args_list[1][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[2][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[3][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[4][0][0] == b"\r\x01"
-    assert mock_serial.write.call_args_list[5][0][0] == b"\x04"
-    assert mock_serial.read_until.call_count == 3
-    assert mock_serial.read_until.call_args_list[0][0][0] == data[0]
-    assert mock_serial.read_until.call_args_list[1][0][0] == data[1]
-    assert mock_serial.read_until.call_args_list[2][0][0] == data[2]
+    reads = [c[0][0] for c in mock_serial.read_until.call_args_list]
+    assert reads == list(RAW_ON_RESPONSES)
+    # Each CTRL-C is followed by a short pause.
+    assert mock_sleep.call_args_list == [mock.call(0.01)] * 3
 
     mock_serial.reset_mock()
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"soft reboot\r\n",
+    in_waiting.reset_mock()
+    mock_serial.read_until.side_effect = [
+        RAW_REPL,
+        SOFT_REBOOT,
         b"foo\r\n",
-        b"raw REPL; CTRL-B to exit\r\n>",
-    ]
-    mock_serial.read_until.side_effect = data
-    microfs.raw_on(mock_serial)
-    assert mock_serial.inWaiting.call_count == 2
-    assert mock_serial.write.call_count == 7
-    assert mock_serial.write.call_args_list[0][0][0] == b"\x02"
-    assert mock_serial.write.call_args_list[1][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[2][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[3][0][0] == b"\r\x03"
-    assert mock_serial.write.call_args_list[4][0][0] == b"\r\x01"
-    assert mock_serial.write.call_args_list[5][0][0] == b"\x04"
-    assert mock_serial.write.call_args_list[6][0][0] == b"\r\x01"
-    assert mock_serial.read_until.call_count == 4
-    assert mock_serial.read_until.call_args_list[0][0][0] == data[0]
-    assert mock_serial.read_until.call_args_list[1][0][0] == data[1]
-    assert mock_serial.read_until.call_args_list[2][0][0] == data[3]
-    assert mock_serial.read_until.call_args_list[3][0][0] == data[3]
-
-
-def test_raw_on_failures():
-    """
-    Check problem data results in an IO error.
-    """
-    mock_serial = mock.MagicMock()
-    mock_serial.inWaiting.side_effect = [5, 3, 2, 1, 0]
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n> foo",
+        RAW_REPL,
     ]
-    mock_serial.read_until.side_effect = data
-    with pytest.raises(IOError) as ex:
-        microfs.raw_on(mock_serial)
-    assert ex.value.args[0] == "Could not enter raw REPL."
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"soft reboot\r\n foo",
-    ]
-    mock_serial.read_until.side_effect = data
-    mock_serial.inWaiting.side_effect = [5, 3, 2, 1, 0]
-    with pytest.raises(IOError) as ex:
-        microfs.raw_on(mock_serial)
-    assert ex.value.args[0] == "Could not enter raw REPL."
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"soft reboot\r\n",
-        b"foo",
-        b"foo",
+    raw_on(mock_serial)
+    assert in_waiting.call_count == 2
+    writes = [c[0][0] for c in mock_serial.write.call_args_list]
+    assert writes == [
+        b"\x02\r\x03",
+        b"\r\x03",
+        b"\r\x03",
+        b"\r\x01",
+        b"\x04",
+        b"\r\x01",
     ]
+    reads = [c[0][0] for c in mock_serial.read_until.call_args_list]
+    assert reads == [RAW_REPL, SOFT_REBOOT, RAW_REPL, RAW_REPL]
+
+
+@pytest.mark.parametrize("command_line_flag", [False, True])
+@pytest.mark.parametrize(
+    "data, waits, printed",
+    [
+        ([RAW_REPL + b" foo"], [11], 0),
+        ([RAW_REPL, SOFT_REBOOT + b" foo"], [11], 1),
+        ([RAW_REPL, SOFT_REBOOT, b"foo", b"foo"], [0], 3),
+    ],
+)
+def test_raw_on_failures(
+    data,
+    waits,
+    printed,
+    command_line_flag,
+    mock_serial,
+    mock_print,
+    monkeypatch,
+):
+    """
+    Check problem data results in an IO error, and the remembered port is
+    forgotten. If the COMMAND_LINE_FLAG is True, ensure the last data
+    received is output via the print statement for debugging purposes. Any
+    pending input is drained in a single read.
+    """
+    type(mock_serial).in_waiting = mock.PropertyMock(side_effect=waits)
     mock_serial.read_until.side_effect = data
-    mock_serial.inWaiting.side_effect = None
-    mock_serial.inWaiting.return_value = 0
+    monkeypatch.setattr("microfs.COMMAND_LINE_FLAG", command_line_flag)
+    monkeypatch.setattr("microfs._PORT_CACHE", ("/dev/ttyACM3", "9900"))
     with pytest.raises(IOError) as ex:
-        microfs.raw_on(mock_serial)
+        raw_on(mock_serial)
     assert ex.value.args[0] == "Could not enter raw REPL."
+    # Whatever answered isn't a working micro:bit, so the port is forgotten.
+    assert microfs._PORT_CACHE is None
+    if waits[0]:
+        mock_serial.read.assert_called_once_with(waits[0])
+    else:
+        assert mock_serial.read.call_count == 0
+    if command_line_flag:
+        mock_print.assert_called_once_with(data[printed])
+    else:
+        assert mock_print.call_count == 0
 
 
-def test_raw_on_failures_command_line_flag_on():
-    """
-    If the COMMAND_LINE_FLAG is True, ensure the last data received is output
-    via the print statemen for debugging purposes.
-    """
-    with mock.patch("builtins.print") as mock_print, mock.patch(
-        "microfs.COMMAND_LINE_FLAG", True
-    ):
-        mock_serial = mock.MagicMock()
-        mock_serial.inWaiting.side_effect = [5, 3, 2, 1, 0]
-        data = [
-            b"raw REPL; CTRL-B to exit\r\n> foo",
-        ]
-        mock_serial.read_until.side_effect = data
-        with pytest.raises(IOError) as ex:
-            microfs.raw_on(mock_serial)
-        mock_print.assert_called_once_with(data[0])
-        assert ex.value.args[0] == "Could not enter raw REPL."
-        mock_print.reset_mock()
-
-        data = [
-            b"raw REPL; CTRL-B to exit\r\n>",
-            b"soft reboot\r\n foo",
-        ]
-        mock_serial.read_until.side_effect = data
-        mock_serial.inWaiting.side_effect = [5, 3, 2, 1, 0]
-        with pytest.raises(IOError) as ex:
-            microfs.raw_on(mock_serial)
-        mock_print.assert_called_once_with(data[1])
-        assert ex.value.args[0] == "Could not enter raw REPL."
-        mock_print.reset_mock()
-        data = [
-            b"raw REPL; CTRL-B to exit\r\n>",
-            b"soft reboot\r\n",
-            b"foo",
-            b"foo",
-        ]
-        mock_serial.read_until.side_effect = data
-        mock_serial.inWaiting.side_effect = None
-        mock_serial.inWaiting.return_value = 0
-        with pytest.raises(IOError) as ex:
-            microfs.raw_on(mock_serial)
-        mock_print.assert_called_once_with(data[3])
-        assert ex.value.args[0] == "Could not enter raw REPL."
-
-
-def test_raw_off():
+def test_raw_off(mock_serial):
     """
     Check that the expected commands are sent to the device to take
     MicroPython out of raw mode.
     """
-    mock_serial = mock.MagicMock()
-    microfs.raw_off(mock_serial)
-    assert mock_serial.write.call_count == 1
-    assert mock_serial.write.call_args_list[0][0][0] == b"\x02"
+    raw_off(mock_serial)
+    mock_serial.write.assert_called_once_with(b"\x02")
 
 
-def test_get_serial():
+def test_get_serial(mock_serial, mocker):
     """
     Ensure that if a port is found then PySerial is used to create a connection
     to the device.
     """
-    mock_serial = mock.MagicMock()
     mock_result = (
         "/dev/ttyACM3",
         "9900000031864e45003c10070000006e0000000097969901",
     )
-    with mock.patch(
-        "microfs.find_microbit", return_value=mock_result
-    ), mock.patch("microfs.Serial", return_value=mock_serial):
-        result = microfs.get_serial()
-        assert result == mock_serial
+    serial = mock.Mock(return_value=mock_serial)
+    mocker.patch("microfs.find_microbit", return_value=mock_result)
+    mocker.patch("microfs.Serial", serial)
+    result = get_serial()
+    assert result == mock_serial
+    serial.assert_called_once_with(
+        "/dev/ttyACM3",
+        microfs.SERIAL_BAUD_RATE,
+        timeout=1,
+        write_timeout=microfs.SERIAL_WRITE_TIMEOUT + 10240 / 115200,
+        parity="N",
+    )
+
+
+def test_get_serial_baudrate(mocker):
+    """
+    Ensure a connection may be opened at a baud rate other than the default.
+    """
+    mock_result = (
+        "/dev/ttyACM3",
+        "9900000031864e45003c10070000006e0000000097969901",
+    )
+    serial = mock.Mock()
+    mocker.patch("microfs.find_microbit", return_value=mock_result)
+    mocker.patch("microfs.Serial", serial)
+    get_serial(baudrate=460800)
+    assert serial.call_args[0] == ("/dev/ttyACM3", 460800)
+
+
+def test_get_serial_slow_baudrate(mocker):
+    """
+    At a slow baud rate, the write timeout allows for the time it takes to
+    send a whole script.
+    """
+    mock_result = ("/dev/ttyACM3", "9900")
+    serial = mock.Mock()
+    mocker.patch("microfs.find_microbit", return_value=mock_result)
+    mocker.patch("microfs.Serial", serial)
+    get_serial(baudrate=9600)
+    # 1024 bytes of 10 bits each take just over a second at 9600 baud.
+    write_timeout = serial.call_args[1]["write_timeout"]
+    assert write_timeout == microfs.SERIAL_WRITE_TIMEOUT + 10240 / 9600
+
+
+def test_get_serial_cannot_open(mocker, monkeypatch):
+    """
+    If the port can't be opened, the remembered port is forgotten so the
+    next attempt scans the ports again.
+    """
+    mock_result = ("/dev/ttyACM3", "9900")
+    monkeypatch.setattr("microfs._PORT_CACHE", mock_result)
+    mocker.patch("microfs.find_microbit", return_value=mock_result)
+    mocker.patch("microfs.Serial", side_effect=IOError("Port is busy"))
+    with pytest.raises(IOError) as ex:
+        get_serial()
+    assert ex.value.args[0] == "Port is busy"
+    assert microfs._PORT_CACHE is None
 
 
-def test_get_serial_no_port():
+def test_get_serial_no_port(mocker):
     """
     An IOError should be raised if no micro:bit is found.
     """
-    with mock.patch("microfs.find_microbit", return_value=(None, None)):
-        with pytest.raises(IOError) as ex:
-            microfs.get_serial()
+    mocker.patch("microfs.find_microbit", return_value=(None, None))
+    with pytest.raises(IOError) as ex:
+        get_serial()
     assert ex.value.args[0] == "Could not find micro:bit."
 
 
-def test_execute():
+def test_read_until(mock_serial):
+    """
+    Ensure whatever is waiting on the serial connection is read in one go
+    until the terminator arrives.
+    """
+    type(mock_serial).in_waiting = mock.PropertyMock(side_effect=[0, 8])
+    mock_serial.read.side_effect = [b"O", b"K[]\x04\x04>"]
+    result = read_until(mock_serial, b"\x04>")
+    assert result == b"OK[]\x04\x04>"
+    assert mock_serial.read.call_args_list == [mock.call(1), mock.call(8)]
+
+
+def test_read_until_timeout(mock_serial):
+    """
+    If the connection times out before the terminator is received, return
+    whatever was read.
+    """
+    mock_serial.in_waiting = 0
+    mock_serial.read.side_effect = [b"OK", b""]
+    result = read_until(mock_serial, b"\x04>")
+    assert result == b"OK"
+
+
+def test_batch_commands():
+    """
+    Ensure commands are joined into a single newline separated script.
+    """
+    result = list(batch_commands(LISTDIR_COMMANDS))
+    assert result == [LISTDIR_SCRIPT]
+
+
+def test_batch_commands_split(monkeypatch):
+    """
+    If the commands add up to more than MAX_SCRIPT_SIZE bytes, they're split
+    into several scripts without breaking any individual command.
+    """
+    commands = ["a = 1", "b = 2", "c = 3", "d = 4"]
+    monkeypatch.setattr("microfs.MAX_SCRIPT_SIZE", 12)
+    result = list(batch_commands(commands))
+    assert result == [b"a = 1\nb = 2", b"c = 3\nd = 4"]
+
+
+def test_batch_commands_long_command(monkeypatch):
+    """
+    A single command longer than MAX_SCRIPT_SIZE is sent on its own.
+    """
+    commands = ["a = 1", "b = '{}'".format("x" * 20), "c = 3"]
+    monkeypatch.setattr("microfs.MAX_SCRIPT_SIZE", 12)
+    result = list(batch_commands(commands))
+    assert result == [b"a = 1", commands[1].encode("utf-8"), b"c = 3"]
+
+
+def test_execute(exec_serial, raw_mode, mocker, mock_sleep):
     """
     Ensure that the expected communication happens via the serial connection
     with the connected micro:bit to facilitate the execution of the passed
     in command.
     """
-    mock_serial = mock.MagicMock()
-    mock_serial.read_until = mock.MagicMock(
-        side_effect=[b"OK\x04\x04>", b"OK[]\x04\x04>"]
-    )
-    commands = [
-        "import os",
-        "os.listdir()",
+    serial = exec_serial(LISTDIR_RESPONSE)
+    serial.in_waiting = len(LISTDIR_RESPONSE)
+    reader = mocker.patch("microfs.read_until", wraps=read_until)
+    out, err = execute(LISTDIR_COMMANDS, serial)
+    # Check the result is correctly parsed.
+    assert out == b"[]"
+    assert err == b""
+    # Check raw_on and raw_off were called.
+    raw_mode["raw_on"].assert_called_once_with(serial)
+    raw_mode["raw_off"].assert_called_once_with(serial)
+    # The device doesn't have raw-paste mode, so the commands are sent as a
+    # single (short) script, followed by the CTRL-D that evaluates it.
+    writes = [c[0][0] for c in serial.write.call_args_list]
+    assert writes == [b"\x05A\x01", LISTDIR_SCRIPT, b"\x04"]
+    assert mock_sleep.call_args_list == [mock.call(0.01)]
+    # The response is read in a blocking read until the prompt arrives,
+    # rather than by polling the connection, and everything that's waiting
+    # is read in one go rather than a byte at a time.
+    reader.assert_called_once_with(serial, b"\x04>")
+    assert serial.read.call_args_list == [
+        mock.call(2),
+        mock.call(len(LISTDIR_RESPONSE)),
+    ]
+
+
+def test_execute_in_raw_mode(exec_serial, raw_mode):
+    """
+    If the device is already in raw mode, the commands are sent without
+    going through the raw mode handshake again, and the device is left in
+    raw mode.
+    """
+    serial = exec_serial(LISTDIR_RESPONSE)
+    out, err = execute(LISTDIR_COMMANDS, serial, in_raw_mode=True)
+    assert out == b"[]"
+    assert serial.write.call_args_list[1] == mock.call(LISTDIR_SCRIPT)
+    assert raw_mode["raw_on"].call_count == 0
+    assert raw_mode["raw_off"].call_count == 0
+
+
+def test_execute_many_scripts(exec_serial, raw_mode, monkeypatch):
+    """
+    Ensure that when the commands are split into several scripts, each is
+    evaluated in turn and the output is combined. Once the device has said
+    it doesn't have raw-paste mode, it isn't asked again.
+    """
+    serial = exec_serial(b"OKfoo\x04\x04>", b"OKbar\x04\x04>")
+    commands = ["print('foo', end='')", "print('bar', end='')"]
+    monkeypatch.setattr("microfs.MAX_SCRIPT_SIZE", 24)
+    out, err = execute(commands, serial)
+    assert out == b"foobar"
+    assert err == b""
+    writes = [c[0][0] for c in serial.write.call_args_list]
+    assert writes == [
+        b"\x05A\x01",
+        b"print('foo', end='')",
+        b"\x04",
+        b"print('bar', end='')",
+        b"\x04",
     ]
-    with mock.patch(
-        "microfs.get_serial", return_value=mock_serial
-    ), mock.patch("microfs.raw_on", return_value=None) as raw_mon, mock.patch(
-        "microfs.raw_off", return_value=None
-    ) as raw_moff:
-        out, err = microfs.execute(commands, mock_serial)
-        # Check the result is correctly parsed.
-        assert out == b"[]"
-        assert err == b""
-        # Check raw_on and raw_off were called.
-        raw_mon.assert_called_once_with(mock_serial)
-        raw_moff.assert_called_once_with(mock_serial)
-        # Check the writes are of the right number and sort (to ensure the
-        # device is put into the correct states).
-        assert mock_serial.write.call_count == 4
-        encoded0 = commands[0].encode("utf-8")
-        encoded1 = commands[1].encode("utf-8")
-        assert mock_serial.write.call_args_list[0][0][0] == encoded0
-        assert mock_serial.write.call_args_list[1][0][0] == b"\x04"
-        assert mock_serial.write.call_args_list[2][0][0] == encoded1
-        assert mock_serial.write.call_args_list[3][0][0] == b"\x04"
-
-
-def test_execute_err_result():
+
+
+def test_execute_long_command(exec_serial, raw_mode, mock_sleep):
+    """
+    Without raw-paste mode there's no flow control, so a long command is
+    written in small chunks with a pause after each.
+    """
+    serial = exec_serial(b"OK\x04\x04>")
+    command = "print('{}')".format("x" * 256).encode("utf-8")
+    execute([command.decode("utf-8")], serial)
+    writes = [c[0][0] for c in serial.write.call_args_list]
+    chunks = [command[i : i + 32] for i in range(0, len(command), 32)]
+    assert writes == [b"\x05A\x01"] + chunks + [b"\x04"]
+    assert mock_sleep.call_args_list == [mock.call(0.01)] * len(chunks)
+
+
+def test_execute_old_firmware(exec_serial, raw_mode):
+    """
+    Firmware that predates raw-paste mode restarts raw mode when asked for
+    it, and the script is then written in paced chunks.
+    """
+    serial = exec_serial(LISTDIR_RESPONSE)
+    serial.read.side_effect = [b"ra", RAW_REPL[2:], LISTDIR_RESPONSE]
+    out, err = execute(LISTDIR_COMMANDS, serial)
+    assert out == b"[]"
+    writes = [c[0][0] for c in serial.write.call_args_list]
+    assert writes == [b"\x05A\x01", LISTDIR_SCRIPT, b"\x04"]
+
+
+@pytest.mark.parametrize(
+    "replies",
+    [[b"??", b""], [b"R\x01", b"\x08"]],
+    ids=["unexpected_reply", "no_window_size"],
+)
+def test_execute_raw_paste_bad_reply(replies, exec_serial, raw_mode):
+    """
+    If the device's reply to the request for raw-paste mode makes no sense,
+    an IOError is raised.
+    """
+    serial = exec_serial()
+    serial.read.side_effect = replies
+    with pytest.raises(IOError) as ex:
+        execute(LISTDIR_COMMANDS, serial)
+    assert ex.value.args[0] == "Could not enter raw REPL."
+
+
+def test_execute_raw_paste(exec_serial, raw_mode, mock_sleep):
+    """
+    A device with raw-paste mode is sent no more of the script than it has
+    room for, and the rest only as it asks for more.
+    """
+    serial = exec_serial()
+    # The device has room for 8 bytes at a time, then asks for 8 more (with
+    # CTRL-A) twice. The response doesn't start with OK in raw-paste mode.
+    serial.read.side_effect = [
+        b"R\x01",
+        b"\x08\x00",
+        b"\x01",
+        b"\x01",
+        b"[]\x04\x04>",
+    ]
+    serial.read_until.return_value = b"\x04"
+    out, err = execute(LISTDIR_COMMANDS, serial)
+    assert out == b"[]"
+    assert err == b""
+    writes = [c[0][0] for c in serial.write.call_args_list]
+    assert writes == [
+        b"\x05A\x01",
+        LISTDIR_SCRIPT[:8],
+        LISTDIR_SCRIPT[8:16],
+        LISTDIR_SCRIPT[16:],
+        b"\x04",
+    ]
+    # The CTRL-D that ends the script is acknowledged by the device.
+    serial.read_until.assert_called_once_with(b"\x04")
+    assert mock_sleep.call_count == 0
+
+
+def test_execute_raw_paste_more_room(exec_serial, raw_mode):
+    """
+    A CTRL-A already waiting to be read gives more room before any of the
+    script is written.
+    """
+    serial = exec_serial()
+    type(serial).in_waiting = mock.PropertyMock(side_effect=[1, 0, 0])
+    serial.read.side_effect = [b"R\x01", b"\x10\x00", b"\x01", b"\x04\x04>"]
+    serial.read_until.return_value = b"\x04"
+    execute(LISTDIR_COMMANDS, serial)
+    assert serial.write.call_args_list[1] == mock.call(LISTDIR_SCRIPT)
+
+
+@pytest.mark.parametrize(
+    "flags, ack",
+    [([b"\x04"], b"\x04"), ([b"\x01", b"\x01"], b"")],
+    ids=["abandoned", "no_acknowledgement"],
+)
+def test_execute_raw_paste_stopped(flags, ack, exec_serial, raw_mode):
+    """
+    If the device gives up on the script, or doesn't acknowledge the end of
+    it, an IOError is raised.
+    """
+    serial = exec_serial()
+    serial.read.side_effect = [b"R\x01", b"\x08\x00"] + flags
+    serial.read_until.return_value = ack
+    with pytest.raises(IOError) as ex:
+        execute(LISTDIR_COMMANDS, serial)
+    assert ex.value.args[0] == "The device stopped accepting data."
+
+
+def test_execute_no_commands(mock_serial, raw_mode):
+    """
+    With no commands to run, nothing is written to the device and the
+    output and error are both empty.
+    """
+    assert execute([], mock_serial) == (b"", b"")
+    assert mock_serial.write.call_count == 0
+
+
+def test_execute_write_timeout(mock_serial, raw_mode):
+    """
+    If the device stops accepting data and the write times out, an IOError
+    is raised.
+    """
+    mock_serial.write.side_effect = microfs.SerialTimeoutException("Timeout")
+    with pytest.raises(IOError) as ex:
+        execute(["import os"], mock_serial)
+    assert ex.value.args[0] == "The device stopped accepting data."
+    # The caller's connection is left for the caller to close.
+    assert mock_serial.close.call_count == 0
+
+
+def test_execute_write_timeout_no_serial(mock_serial, raw_mode, mocker):
+    """
+    If execute opened the connection itself, it's closed even though the
+    write timed out.
+    """
+    mock_serial.write.side_effect = microfs.SerialTimeoutException("Timeout")
+    mocker.patch("microfs.get_serial", return_value=mock_serial)
+    with pytest.raises(IOError):
+        execute(["import os"])
+    mock_serial.close.assert_called_once_with()
+
+
+def test_execute_err_result(exec_serial):
     """
     Ensure that if there's a problem reported via stderr on the Microbit, it's
     returned as such by the execute function.
     """
-    mock_serial = mock.MagicMock()
-    mock_serial.inWaiting.return_value = 0
-    data = [
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"soft reboot\r\n",
-        b"raw REPL; CTRL-B to exit\r\n>",
-        b"OK\x04Error\x04>",
-    ]
-    mock_serial.read_until.side_effect = data
-    command = "import os; os.listdir()"
-    with mock.patch("microfs.get_serial", return_value=mock_serial):
-        out, err = microfs.execute(command, mock_serial)
-        # Check the result is correctly parsed.
-        assert out == b""
-        assert err == b"Error"
+    serial = exec_serial(b"OK\x04Error\x04>")
+    serial.read_until.side_effect = RAW_ON_RESPONSES
+    out, err = execute(["import os; os.listdir()"], serial)
+    # Check the result is correctly parsed.
+    assert out == b""
+    assert err == b"Error"
 
 
-def test_execute_no_serial():
+def test_execute_no_serial(exec_serial, raw_mode, mocker):
     """
     Ensure that if there's no serial object passed into the execute method, it
     attempts to get_serial().
     """
-    mock_serial = mock.MagicMock()
-    mock_serial.read_until = mock.MagicMock(
-        side_effect=[b"OK\x04\x04>", b"OK[]\x04\x04>"]
-    )
-    commands = [
-        "import os",
-        "os.listdir()",
-    ]
-    with mock.patch(
-        "microfs.get_serial", return_value=mock_serial
-    ) as p, mock.patch("microfs.raw_on", return_value=None), mock.patch(
-        "microfs.raw_off", return_value=None
-    ):
-        out, err = microfs.execute(commands)
-        p.assert_called_once_with()
-        mock_serial.close.assert_called_once_with()
+    serial = exec_serial(LISTDIR_RESPONSE)
+    mock_get_serial = mocker.patch("microfs.get_serial", return_value=serial)
+    out, err = execute(LISTDIR_COMMANDS)
+    mock_get_serial.assert_called_once_with()
+    serial.close.assert_called_once_with()
 
 
-def test_clean_error():
+@pytest.mark.parametrize(
+    "msg, expected",
+    [
+        (TRACEBACK, "OSError: file not found"),
+        (b"This does not conform!", "This does not conform!"),
+        (b"", "There was an error."),
+    ],
+    ids=["traceback", "no_stack_trace", "no_error"],
+)
+def test_clean_error(msg, expected):
     """
     Check that given some bytes (derived from stderr) are turned into a
     readable error message: we're only interested in getting the error message
     from the exception, so it's important to strip away all the potentially
     confusing stack trace if it exists.
+
+    Sometimes stderr may not conform to the expected stacktrace structure. In
+    which case, just return a string version of the message. Worst case, the
+    function has been called with empty bytes so return a vague message.
     """
-    msg = (
-        b"Traceback (most recent call last):\r\n "
-        b'File "<stdin>", line 2, in <module>\r\n'
-        b'File "<stdin>", line 2, in <module>\r\n'
-        b'File "<stdin>", line 2, in <module>\r\n'
-        b"OSError: file not found\r\n"
-    )
-    result = microfs.clean_error(msg)
-    assert result == "OSError: file not found"
+    assert clean_error(msg) == expected
 
 
-def test_clean_error_no_stack_trace():
+def test_ls(mock_serial, execute_mock):
     """
-    Sometimes stderr may not conform to the expected stacktrace structure. In
-    which case, just return a string version of the message.
+    If filenames are returned one per line in stdout, ensure that the
+    equivalent Python list is returned from ls.
     """
-    msg = b"This does not conform!"
-    assert microfs.clean_error(msg) == "This does not conform!"
+    execute_mock.return_value = (b"a.txt\r\n", b"")
+    result = ls(mock_serial)
+    assert result == ["a.txt"]
+    execute_mock.assert_called_once_with(LS_COMMANDS, mock_serial, False)
 
 
-def test_clean_error_but_no_error():
+def test_ls_no_files(execute_mock):
     """
-    Worst case, the function has been called with empty bytes so return a
-    vague message.
+    If nothing is returned in stdout, ls returns an empty list.
     """
-    assert microfs.clean_error(b"") == "There was an error."
+    assert ls() == []
 
 
-def test_ls():
+def test_ls_utf8_names(execute_mock):
     """
-    If a list is returned as a result in stdout, ensure that the equivalent
-    Python list is returned from ls.
+    Each filename is decoded from the UTF-8 bytes the device prints.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch(
-        "microfs.execute", return_value=(b"[ 'a.txt']\r\n", b"")
-    ) as execute:
-        result = microfs.ls(mock_serial)
-        assert result == ["a.txt"]
-        execute.assert_called_once_with(
-            [
-                "import os",
-                "print(os.listdir())",
-            ],
-            mock_serial,
-        )
+    out = "caf\u00e9.txt\r\n\u00fcber.py\r\n".encode("utf-8")
+    execute_mock.return_value = (out, b"")
+    assert ls() == ["caf\u00e9.txt", "\u00fcber.py"]
 
 
-def test_ls_width_delimiter():
+def test_ls_width_delimiter(mock_serial, execute_mock):
     """
     If a delimiter is provided, ensure that the result from stdout is
     equivalent to the list returned by Python.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch(
-        "microfs.execute", return_value=(b"[ 'a.txt','b.txt']\r\n", b"")
-    ) as execute:
-        result = microfs.ls(mock_serial)
-        delimitedResult = ";".join(result)
-        assert delimitedResult == "a.txt;b.txt"
-        execute.assert_called_once_with(
-            [
-                "import os",
-                "print(os.listdir())",
-            ],
-            mock_serial,
-        )
+    execute_mock.return_value = (b"a.txt\r\nb.txt\r\n", b"")
+    result = ls(mock_serial)
+    delimitedResult = ";".join(result)
+    assert delimitedResult == "a.txt;b.txt"
+    execute_mock.assert_called_once_with(LS_COMMANDS, mock_serial, False)
 
 
-def test_ls_with_error():
+def test_ls_detailed(mock_serial, execute_mock):
     """
-    Ensure an IOError is raised if stderr returns something.
+    Ensure the size and name printed for each file are turned into a list of
+    (name, size) tuples, allowing for spaces in names.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"error")):
-        with pytest.raises(IOError) as ex:
-            microfs.ls(mock_serial)
-    assert ex.value.args[0] == "error"
+    execute_mock.return_value = (b"16 a.txt\r\n1024 b c.py\r\n", b"")
+    result = ls_detailed(mock_serial)
+    assert result == [("a.txt", 16), ("b c.py", 1024)]
+    commands = execute_mock.call_args[0][0]
+    assert commands[-1] == "for n in os.listdir():\n print(s(n), n)"
+    assert execute_mock.call_args[0][1] == mock_serial
 
 
-def test_rm():
+def test_rm(mock_serial, execute_mock):
     """
     Given a filename and nothing in stderr from the micro:bit, return True.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"")) as execute:
-        assert microfs.rm("foo", mock_serial)
-        execute.assert_called_once_with(
-            [
-                "import os",
-                "os.remove('foo')",
-            ],
-            mock_serial,
-        )
+    assert rm("foo", mock_serial)
+    execute_mock.assert_called_once_with(
+        (
+            "import os",
+            "os.remove('foo')",
+        ),
+        mock_serial,
+        False,
+    )
 
 
-def test_rm_with_error():
+@pytest.mark.parametrize(
+    "target, expected_name",
+    [("remote.txt", "remote.txt"), (None, "fixture_file.txt")],
+)
+def test_put(
+    target,
+    expected_name,
+    fixture_encoded,
+    mock_serial,
+    put_device,
+    execute_mock,
+):
     """
-    Ensure an IOError is raised if stderr returns something.
+    Ensure a put of an existing file results in the expected calls to the
+    micro:bit and returns True. The content is sent base64 encoded. If no
+    target is provided, use the name of the local file.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"error")):
-        with pytest.raises(IOError) as ex:
-            microfs.rm("foo", mock_serial)
-    assert ex.value.args[0] == "error"
+    path = "tests/fixture_file.txt"
+    assert put(path, target, mock_serial)
+    put_device.assert_called_once_with(mock_serial)
+    commands = [
+        PUT_IMPORT,
+        "fd = open('{}', 'wb')".format(expected_name),
+        "f = fd.write",
+        "f(a(b'{}'))".format(fixture_encoded),
+        "fd.close()",
+    ]
+    assert execute_mock.call_count == 1
+    # The commands are streamed to execute, so the whole file is never held
+    # in memory.
+    sent = execute_mock.call_args[0][0]
+    assert iter(sent) is sent
+    assert list(sent) == commands
+    # The device was put into raw mode before asking if it has base64.
+    assert execute_mock.call_args[0][1:] == (mock_serial, True)
+
+
+@pytest.mark.parametrize(
+    "content, line_lengths",
+    [
+        # A binary file smaller than a single block.
+        (bytes(bytearray(range(256))), [96, 96, 96, 56]),
+        # A file larger than the blocks it's read in.
+        (bytes(bytearray(range(256))) * 20, [96] * 71 + [12]),
+    ],
+    ids=["small", "large"],
+)
+def test_put_binary_file(
+    tmpdir, content, line_lengths, put_device, execute_mock
+):
+    """
+    Ensure the content of a binary file is split into lines of 96 base64
+    characters, each of which decodes on its own, and survives the round trip.
+    """
+    path = tmpdir.join("binary.bin")
+    path.write_binary(content)
+    assert put(str(path))
+    lines = list(execute_mock.call_args[0][0])[3:-1]
+    assert [len(line[6:-3]) for line in lines] == line_lengths
+    decoded = b"".join(base64.b64decode(line[6:-3]) for line in lines)
+    assert decoded == content
+
+
+@pytest.mark.parametrize("size, scripts", [(64, 1), (1024, 2), (4096, 7)])
+def test_put_chunked(tmpdir, size, scripts, put_device, execute_mock):
+    """
+    Ensure the commands to put a large file are sent as several scripts, none
+    of which is longer than MAX_SCRIPT_SIZE, rather than as one huge script
+    the device may not have the memory to compile.
+    """
+    path = tmpdir.join("data.bin")
+    path.write_binary(b"\xff" * size)
+    assert put(str(path))
+    result = list(batch_commands(execute_mock.call_args[0][0]))
+    assert len(result) == scripts
+    assert all(len(script) <= microfs.MAX_SCRIPT_SIZE for script in result)
+    assert b"fd = open('data.bin', 'wb')" in result[0]
+    assert result[-1].endswith(b"fd.close()")
+
+
+def test_put_many(tmpdir, mock_serial, put_device, execute_mock):
+    """
+    Ensure several files are copied onto the device via a single call to
+    execute, each named after the local file.
+    """
+    first = tmpdir.join("first.txt")
+    first.write_binary(b"hello")
+    second = tmpdir.join("second.txt")
+    second.write_binary(b"world")
+    assert put_many([str(first), str(second)], mock_serial)
+    put_device.assert_called_once_with(mock_serial)
+    assert execute_mock.call_count == 1
+    commands = list(execute_mock.call_args[0][0])
+    assert execute_mock.call_args[0][1:] == (mock_serial, True)
+    expected = list(put_commands(str(first), "first.txt")) + list(
+        put_commands(str(second), "second.txt")
+    )
+    assert commands == expected
+    assert "fd = open('second.txt', 'wb')" in commands
+    assert "f(a(b'd29ybGQ='))" in commands
 
 
-def test_put_python3():
+def test_put_without_base64(tmpdir, mock_serial, put_device, execute_mock):
     """
-    Ensure a put of an existing file results in the expected calls to the
-    micro:bit and returns True.
+    A device that can't decode base64 (such as a micro:bit V1) is sent the
+    content of the file as bytes literals, 64 bytes at a time.
     """
-    path = "tests/fixture_file.txt"
-    target = "remote.txt"
-    mock_serial = mock.MagicMock()
-    with open(path, "r") as fixture_file:
-        content = fixture_file.read()
-        with mock.patch("microfs.execute", return_value=(b"", b"")) as execute:
-            with mock.patch("microfs.PY2", False):
-                with mock.patch.object(
-                    builtins, "repr", return_value="b'{}'".format(content)
-                ):
-                    assert microfs.put(path, target, mock_serial)
-            commands = [
-                "fd = open('{}', 'wb')".format("remote.txt"),
-                "f = fd.write",
-                "f(b'{}')".format(content),
-                "fd.close()",
-            ]
-            execute.assert_called_once_with(commands, mock_serial)
-
-
-def test_put_no_target_python3():
+    put_device.return_value = False
+    content = bytes(bytearray(range(256))) + b"end"
+    path = tmpdir.join("binary.bin")
+    path.write_binary(content)
+    assert put(str(path), serial=mock_serial)
+    commands = list(execute_mock.call_args[0][0])
+    assert commands[:2] == ["fd = open('binary.bin', 'wb')", "f = fd.write"]
+    assert commands[-1] == "fd.close()"
+    lines = commands[2:-1]
+    assert len(lines) == 5
+    assert lines[0] == "f(" + repr(content[:64]) + ")"
+    assert b"".join(ast.literal_eval(line[2:-1]) for line in lines) == content
+
+
+def test_has_base64(mock_serial, execute_mock):
     """
-    Ensure a put of an existing file results in the expected calls to the
-    micro:bit and returns True.
+    Ensure the device, already in raw mode, is asked whether it can decode
+    base64.
     """
-    path = "tests/fixture_file.txt"
-    mock_serial = mock.MagicMock()
-    with open(path, "r") as fixture_file:
-        content = fixture_file.read()
-        with mock.patch("microfs.execute", return_value=(b"", b"")) as execute:
-            with mock.patch("microfs.PY2", False):
-                with mock.patch.object(
-                    builtins, "repr", return_value="b'{}'".format(content)
-                ):
-                    assert microfs.put(path, None, mock_serial)
-            commands = [
-                "fd = open('{}', 'wb')".format("fixture_file.txt"),
-                "f = fd.write",
-                "f(b'{}')".format(content),
-                "fd.close()",
-            ]
-            execute.assert_called_once_with(commands, mock_serial)
-
-
-def test_put_python2():
+    execute_mock.return_value = (b"True\r\n", b"")
+    assert has_base64(mock_serial)
+    execute_mock.assert_called_once_with(
+        microfs._BASE64_PROBE, mock_serial, True
+    )
+    execute_mock.return_value = (b"False\r\n", b"")
+    assert not has_base64(mock_serial)
+
+
+def test_put_probe_shares_raw_mode(mock_serial, raw_mode, mocker):
     """
-    Ensure a put of an existing file results in the expected calls to the
-    micro:bit and returns True when running on Python 2.
+    Asking the device about base64 and copying the file share the one trip
+    into and out of raw mode.
     """
-    path = "tests/fixture_file.txt"
-    target = "remote.txt"
-    mock_serial = mock.MagicMock()
-    with open(path, "r") as fixture_file:
-        content = fixture_file.read()
-        with mock.patch("microfs.execute", return_value=(b"", b"")) as execute:
-            with mock.patch("microfs.PY2", True):
-                with mock.patch.object(
-                    builtins, "repr", return_value="'{}'".format(content)
-                ):
-                    assert microfs.put(path, target, mock_serial)
-            commands = [
-                "fd = open('{}', 'wb')".format("remote.txt"),
-                "f = fd.write",
-                "f(b'{}')".format(content),
-                "fd.close()",
-            ]
-            execute.assert_called_once_with(commands, mock_serial)
-
-
-def test_put_no_target_python2():
+    execute = mocker.patch(
+        "microfs.execute", side_effect=[(b"True\r\n", b""), (b"", b"")]
+    )
+    assert put("tests/fixture_file.txt", serial=mock_serial)
+    raw_mode["raw_on"].assert_called_once_with(mock_serial)
+    raw_mode["raw_off"].assert_called_once_with(mock_serial)
+    assert [c[0][1:] for c in execute.call_args_list] == [
+        (mock_serial, True),
+        (mock_serial, True),
+    ]
+    assert next(execute.call_args[0][0]) == microfs._A2B_IMPORT
+
+
+def test_put_many_no_files(execute_mock):
     """
-    Ensure a put of an existing file results in the expected calls to the
-    micro:bit and returns True when running on Python 2.
+    With no files to copy, put_many succeeds without touching the device.
     """
-    path = "tests/fixture_file.txt"
-    mock_serial = mock.MagicMock()
-    with open(path, "r") as fixture_file:
-        content = fixture_file.read()
-        with mock.patch("microfs.execute", return_value=(b"", b"")) as execute:
-            with mock.patch("microfs.PY2", True):
-                with mock.patch.object(
-                    builtins, "repr", return_value="'{}'".format(content)
-                ):
-                    assert microfs.put(path, None, mock_serial)
-            commands = [
-                "fd = open('{}', 'wb')".format("fixture_file.txt"),
-                "f = fd.write",
-                "f(b'{}')".format(content),
-                "fd.close()",
-            ]
-            execute.assert_called_once_with(commands, mock_serial)
-
-
-def test_put_non_existent_file():
+    assert put_many([])
+    assert execute_mock.call_count == 0
+
+
+def test_put_many_non_existent_file(execute_mock):
+    """
+    Raise an IOError naming the missing file, before anything is sent to the
+    device, if any of the files doesn't exist.
+    """
+    with pytest.raises(IOError) as ex:
+        put_many(["tests/fixture_file.txt", "tests/foo.txt"])
+    assert ex.value.args[0] == "No such file: tests/foo.txt"
+    assert execute_mock.call_count == 0
+
+
+def test_put_non_existent_file(execute_mock):
     """
     Raise an IOError if put attempts to work with a non-existent file on the
-    local file system.
+    local file system, before trying to connect to the device.
     """
-    mock_serial = mock.MagicMock()
     with pytest.raises(IOError) as ex:
-        microfs.put("tests/foo.txt", mock_serial)
+        put("tests/foo.txt")
+    assert execute_mock.call_count == 0
     assert ex.value.args[0] == "No such file."
 
 
-def test_put_with_error():
+@pytest.mark.parametrize(
+    "target, serial, expected_name",
+    [
+        ("local.txt", mock.Mock(baudrate=115200), "local.txt"),
+        (None, None, "hello.txt"),
+    ],
+)
+def test_get(target, serial, expected_name, mocker, execute_mock):
     """
-    Ensure an IOError is raised if stderr returns something.
+    Ensure a successful get results in the expected file getting written on
+    the local file system with the expected content. If no target is
+    provided, use the name of the remote file.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"error")):
-        with pytest.raises(IOError) as ex:
-            microfs.put("tests/fixture_file.txt", mock_serial)
-    assert ex.value.args[0] == "error"
+    execute_mock.return_value = (b"aGVsbG8=\n", b"")
+    mo, handle = make_open_mock()
+    mocker.patch("microfs.open", mo, create=True)
+    assert get("hello.txt", target, serial)
+    execute_mock.assert_called_once_with(GET_HELLO_COMMANDS, serial, False)
+    mo.assert_called_once_with(expected_name, "wb")
+    handle.write.assert_called_once_with(b"hello")
 
 
-def test_get():
+def test_get_without_base64(mocker, execute_mock):
     """
-    Ensure a successful get results in the expected file getting written on
-    the local file system with the expected content.
+    A device without a base64 encoder (such as a micro:bit V1) sends each
+    chunk as a bytes literal on a line of its own, which are evaluated and
+    recombined into the original binary content.
     """
-    mock_serial = mock.MagicMock()
-    commands = [
-        "\n".join(
-            [
-                "try:",
-                " from microbit import uart as u",
-                "except ImportError:",
-                " try:",
-                "  from machine import UART",
-                "  u = UART(0, {})".format(microfs.SERIAL_BAUD_RATE),
-                " except Exception:",
-                "  try:",
-                "   from sys import stdout as u",
-                "  except Exception:",
-                "   raise Exception('Could not find UART module in device.')",
-            ]
-        ),
-        "f = open('{}', 'rb')".format("hello.txt"),
-        "r = f.read",
-        "result = True",
-        "\n".join(
-            [
-                "while result:",
-                " result = r(32)",
-                " if result:",
-                "  u.write(repr(result))",
-            ]
-        ),
-        "f.close()",
-    ]
-    with mock.patch("microfs.execute", return_value=(b"b'hello'", b"")) as exe:
-        mo = mock.mock_open()
-        with mock.patch("microfs.open", mo, create=True):
-            assert microfs.get("hello.txt", "local.txt", mock_serial)
-            exe.assert_called_once_with(commands, mock_serial)
-            mo.assert_called_once_with("local.txt", "wb")
-            handle = mo()
-            handle.write.assert_called_once_with(b"hello")
+    content = bytes(bytearray(range(256))) + b"'\"end"
+    out = b"".join(
+        repr(content[i : i + 32]).encode("ascii") + b"\r\n"
+        for i in range(0, len(content), 32)
+    )
+    mo, handle = make_open_mock()
+    execute_mock.return_value = (out, b"")
+    mocker.patch("microfs.open", mo, create=True)
+    assert get("data.bin")
+    handle.write.assert_called_once_with(content)
 
 
-def test_get_no_target():
+def test_get_baudrate(mock_serial, mocker, execute_mock):
     """
-    Ensure a successful get results in the expected file getting written on
-    the local file system with the expected content. In this case, since no
-    target is provided, use the name of the remote file.
+    A device that has to set its UART up is given the baud rate of the
+    connection.
     """
-    commands = [
-        "\n".join(
-            [
-                "try:",
-                " from microbit import uart as u",
-                "except ImportError:",
-                " try:",
-                "  from machine import UART",
-                "  u = UART(0, {})".format(microfs.SERIAL_BAUD_RATE),
-                " except Exception:",
-                "  try:",
-                "   from sys import stdout as u",
-                "  except Exception:",
-                "   raise Exception('Could not find UART module in device.')",
-            ]
-        ),
-        "f = open('{}', 'rb')".format("hello.txt"),
-        "r = f.read",
-        "result = True",
-        "\n".join(
-            [
-                "while result:",
-                " result = r(32)",
-                " if result:",
-                "  u.write(repr(result))",
-            ]
-        ),
-        "f.close()",
-    ]
-    with mock.patch("microfs.execute", return_value=(b"b'hello'", b"")) as exe:
-        mo = mock.mock_open()
-        with mock.patch("microfs.open", mo, create=True):
-            assert microfs.get("hello.txt")
-            exe.assert_called_once_with(commands, None)
-            mo.assert_called_once_with("hello.txt", "wb")
-            handle = mo()
-            handle.write.assert_called_once_with(b"hello")
+    mock_serial.baudrate = 460800
+    mocker.patch("microfs.open", mock.mock_open(), create=True)
+    assert get("hello.txt", serial=mock_serial)
+    commands = execute_mock.call_args[0][0]
+    assert "  u = UART(0, 460800)" in commands[0].splitlines()
 
 
-def test_get_with_error():
+def test_get_many_chunks(mocker, execute_mock):
+    """
+    Ensure the base64 encoded line for each chunk read on the device is
+    decoded and recombined into the original binary content.
+    """
+    content = bytes(bytearray(range(256))) * 3 + b"end"
+    out = b"".join(
+        base64.b64encode(content[i : i + 256]) + b"\r\n"
+        for i in range(0, len(content), 256)
+    )
+    mo, handle = make_open_mock()
+    execute_mock.return_value = (out, b"")
+    mocker.patch("microfs.open", mo, create=True)
+    assert get("data.bin")
+    handle.write.assert_called_once_with(content)
+
+
+@pytest.mark.parametrize(
+    "command, args",
+    [
+        (ls, ()),
+        (ls_detailed, ()),
+        (rm, ("foo",)),
+        (put, ("tests/fixture_file.txt",)),
+        (put_many, (["tests/fixture_file.txt"],)),
+        (get, ("foo.txt",)),
+    ],
+)
+def test_command_with_error(command, args, put_device, execute_mock):
     """
     Ensure an IOError is raised if stderr returns something.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"error")):
-        with pytest.raises(IOError) as ex:
-            microfs.get("foo.txt", mock_serial)
+    execute_mock.return_value = (b"", b"error")
+    with pytest.raises(IOError) as ex:
+        command(*args)
     assert ex.value.args[0] == "error"
 
 
-def test_version_good_output():
+def test_version_good_output(mock_serial, execute_mock):
     """
     Ensure the version method returns the expected result when the response
     from the device is the expected bytes.
@@ -674,211 +1051,247 @@ def test_version_good_output():
         b'MicroPython v1.9.2-34-gd64154c73 on 2017-09-01", '
         b"machine='micro:bit with nRF51822')\r\n"
     )
-    mock_serial = mock.MagicMock()
-    with mock.patch(
-        "microfs.execute", return_value=(response, b"")
-    ) as execute:
-        result = microfs.version(mock_serial)
-        assert result["sysname"] == "microbit"
-        assert result["nodename"] == "microbit"
-        assert result["release"] == "1.0"
-        assert result["version"] == (
-            "micro:bit v1.0-b'e10a5ff' on "
-            "2018-6-8; "
-            "MicroPython v1.9.2-34-gd64154c73 on "
-            "2017-09-01"
-        )
-        assert result["machine"] == "micro:bit with nRF51822"
-        execute.assert_called_once_with(
-            [
-                "import os",
-                "print(os.uname())",
-            ],
-            mock_serial,
-        )
-
-
-def test_version_with_std_err_output():
+    execute_mock.return_value = (response, b"")
+    result = version(mock_serial)
+    assert result["sysname"] == "microbit"
+    assert result["nodename"] == "microbit"
+    assert result["release"] == "1.0"
+    assert result["version"] == (
+        "micro:bit v1.0-b'e10a5ff' on "
+        "2018-6-8; "
+        "MicroPython v1.9.2-34-gd64154c73 on "
+        "2017-09-01"
+    )
+    assert result["machine"] == "micro:bit with nRF51822"
+    execute_mock.assert_called_once_with(
+        (
+            "import os",
+            "print(os.uname())",
+        ),
+        mock_serial,
+    )
+
+
+def test_version_with_std_err_output(mock_serial, execute_mock):
     """
     Ensure a ValueError is raised if stderr returns something.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", return_value=(b"", b"error")):
-        with pytest.raises(ValueError) as ex:
-            microfs.version(mock_serial)
+    execute_mock.return_value = (b"", b"error")
+    with pytest.raises(ValueError) as ex:
+        version(mock_serial)
     assert ex.value.args[0] == "error"
 
 
-def test_version_encountered_unknown_problem_when_executing_commands():
+def test_version_encountered_unknown_problem_when_executing_commands(
+    mock_serial, execute_mock
+):
     """
     Ensure a ValueError is raised if some other error was encountered when
     trying to connect to the device and read the output of os.uname.
     """
-    mock_serial = mock.MagicMock()
-    with mock.patch("microfs.execute", side_effect=IOError("boom")):
-        with pytest.raises(ValueError):
-            microfs.version(mock_serial)
+    execute_mock.side_effect = IOError("boom")
+    with pytest.raises(ValueError):
+        version(mock_serial)
 
 
-def test_main_no_args():
+def test_main_no_args(mocker, monkeypatch):
     """
     If no args are passed, simply display help.
     """
-    with mock.patch(
-        "sys.argv",
-        [
-            "ufs",
-        ],
-    ):
-        mock_parser = mock.MagicMock()
-        with mock.patch(
-            "microfs.argparse.ArgumentParser", return_value=mock_parser
-        ):
-            microfs.main()
-        mock_parser.print_help.assert_called_once_with()
+    monkeypatch.setattr("sys.argv", ["ufs"])
+    mock_parser = mock.Mock(
+        spec=["add_argument", "add_subparsers", "parse_args", "print_help"]
+    )
+    mocker.patch("argparse.ArgumentParser", return_value=mock_parser)
+    main()
+    mock_parser.print_help.assert_called_once_with()
 
 
-def test_main_ls():
+def test_main_ls(mock_serial, patch_microfs, mock_print):
     """
     If the ls command is issued, check the appropriate function is called.
     """
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch(
-        "microfs.ls", return_value=["foo", "bar"]
-    ) as mock_ls, mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ), mock.patch.object(
-        builtins, "print"
-    ) as mock_print:
-        microfs.main(argv=["ls"])
-        mock_ls.assert_called_once_with()
-        mock_print.assert_called_once_with("foo bar")
+    patch_microfs["ls"].return_value = ["foo", "bar"]
+    main(argv=["ls"])
+    patch_microfs["ls"].assert_called_once_with(mock_serial, False)
+    mock_print.assert_called_once_with("foo bar")
 
 
-def test_main_ls_no_files():
+def test_main_ls_long(mock_serial, patch_microfs, mock_print):
+    """
+    If the ls command is issued with the long flag, each file is printed on
+    its own line along with its size.
+    """
+    patch_microfs["ls_detailed"].return_value = [("foo", 16), ("bar", 1024)]
+    main(argv=["ls", "-l"])
+    patch_microfs["ls_detailed"].assert_called_once_with(mock_serial, False)
+    assert mock_print.call_args_list == [
+        mock.call("      16 foo"),
+        mock.call("    1024 bar"),
+    ]
+
+
+def test_main_ls_no_files(mock_serial, patch_microfs, mock_print):
     """
     If the ls command is issued and no files exist, nothing is printed.
     """
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch("microfs.ls", return_value=[]) as mock_ls, mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ), mock.patch.object(builtins, "print") as mock_print:
-        microfs.main(argv=["ls"])
-        mock_ls.assert_called_once_with()
-        assert mock_print.call_count == 0
+    patch_microfs["ls"].return_value = []
+    main(argv=["ls"])
+    patch_microfs["ls"].assert_called_once_with(mock_serial, False)
+    assert mock_print.call_count == 0
+
+
+def test_main_baudrate(mock_serial, patch_microfs, mock_print):
+    """
+    If a baud rate is given, the connection to the device is opened at that
+    rate rather than the default.
+    """
+    patch_microfs["ls"].return_value = []
+    main(argv=["--baudrate", "460800", "ls"])
+    patch_microfs["get_serial"].assert_called_once_with(460800)
+    patch_microfs["ls"].assert_called_once_with(mock_serial, False)
 
 
-def test_main_rm():
+@pytest.mark.parametrize(
+    "command, args",
+    [("rm", ("foo",)), ("put", ("foo", None)), ("get", ("foo", None))],
+)
+def test_main_file_command(command, args, mock_serial, patch_microfs):
     """
-    If the rm command is correctly issued, check the appropriate function is
-    called.
+    If the rm, put or get command is correctly issued, check the appropriate
+    function is called.
     """
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch("microfs.rm", return_value=True) as mock_rm, mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ):
-        microfs.main(argv=["rm", "foo"])
-        mock_rm.assert_called_once_with("foo")
+    main(argv=[command, "foo"])
+    patch_microfs[command].assert_called_once_with(*args, mock_serial, False)
 
 
-def test_main_rm_no_filename():
+@pytest.mark.parametrize("command", ["rm", "put", "get"])
+def test_main_no_filename(command, patch_microfs, mock_print):
     """
-    If rm is not called with an associated filename, then print an error
-    message.
+    If rm, put or get is not called with an associated filename, then print
+    an error message.
     """
-    with mock.patch("microfs.rm", return_value=True) as mock_rm:
-        with mock.patch.object(builtins, "print") as mock_print, pytest.raises(
-            SystemExit
-        ) as pytest_exc:
-            microfs.main(argv=["rm"])
-    assert mock_print.call_count == 1
-    assert mock_rm.call_count == 0
+    with pytest.raises(SystemExit) as pytest_exc:
+        main(argv=[command])
+    mock_print.assert_called_once_with(
+        '{0}: missing filename. (e.g. "ufs {0} foo.txt")'.format(command)
+    )
+    assert patch_microfs[command].call_count == 0
     assert pytest_exc.type == SystemExit
     assert pytest_exc.value.code == 2
 
 
-def test_main_put():
+def test_main_handle_exception(patch_microfs, mock_print):
     """
-    If the put command is correctly issued, check the appropriate function is
-    called.
+    If an exception is raised, then it gets printed.
     """
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch("microfs.put", return_value=True) as mock_put, mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ):
-        microfs.main(argv=["put", "foo"])
-        mock_put.assert_called_once_with("foo", None)
+    ex = ValueError("Error")
+    patch_microfs["get"].side_effect = ex
+    with pytest.raises(SystemExit) as pytest_exc:
+        main(argv=["get", "foo"])
+    mock_print.assert_called_once_with(ex)
+    assert pytest_exc.type == SystemExit
+    assert pytest_exc.value.code == 1
 
 
-def test_main_put_no_filename():
+def test_main_batch(mock_serial, patch_microfs, monkeypatch):
     """
-    If put is not called with an associated filename, then print an error
-    message.
+    If the batch command is issued, each command read from stdin is run via
+    a single serial connection.
     """
-    with mock.patch("microfs.put", return_value=True) as mock_put:
-        with mock.patch.object(builtins, "print") as mock_print, pytest.raises(
-            SystemExit
-        ) as pytest_exc:
-            microfs.main(argv=["put"])
-    assert mock_print.call_count == 1
-    assert mock_put.call_count == 0
-    assert pytest_exc.type == SystemExit
-    assert pytest_exc.value.code == 2
+    stdin = io.StringIO(
+        "put foo.txt\n\nget 'bar baz.txt' qux.txt\nrm foo.txt\n"
+    )
+    monkeypatch.setattr("sys.stdin", stdin)
+    main(argv=["batch"])
+    patch_microfs["get_serial"].assert_called_once_with(
+        microfs.SERIAL_BAUD_RATE
+    )
+    # The device is put into raw mode once for the whole batch.
+    patch_microfs["raw_on"].assert_called_once_with(mock_serial)
+    patch_microfs["raw_off"].assert_called_once_with(mock_serial)
+    patch_microfs["put"].assert_called_once_with(
+        "foo.txt", None, mock_serial, True
+    )
+    patch_microfs["get"].assert_called_once_with(
+        "bar baz.txt", "qux.txt", mock_serial, True
+    )
+    patch_microfs["rm"].assert_called_once_with("foo.txt", mock_serial, True)
 
 
-def test_main_get():
+def test_main_batch_windows_paths(mock_serial, patch_microfs, monkeypatch):
     """
-    If the get command is correctly issued, check the appropriate function is
-    called.
+    Backslashes in a batch are kept rather than treated as escapes, so
+    Windows paths (quoted or not) come through unchanged.
     """
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch("microfs.get", return_value=True) as mock_get, mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ):
-        microfs.main(argv=["get", "foo"])
-        mock_get.assert_called_once_with("foo", None)
+    stdin = io.StringIO(
+        "put C:\\Users\\me\\main.py\n"
+        'get foo.txt "C:\\Users\\me\\my files\\foo.txt"\n'
+    )
+    monkeypatch.setattr("sys.stdin", stdin)
+    main(argv=["batch"])
+    patch_microfs["put"].assert_called_once_with(
+        "C:\\Users\\me\\main.py", None, mock_serial, True
+    )
+    patch_microfs["get"].assert_called_once_with(
+        "foo.txt", "C:\\Users\\me\\my files\\foo.txt", mock_serial, True
+    )
 
 
-def test_main_get_no_filename():
+@pytest.mark.parametrize("option", ["--baudrate", "-b"])
+def test_main_batch_option(option, patch_microfs, mock_print, monkeypatch):
     """
-    If get is not called with an associated filename, then print an error
-    message.
+    Options such as --baudrate apply to the whole batch, so a line of the
+    batch that starts with one is an error rather than silently ignored.
     """
-    with mock.patch("microfs.get", return_value=True) as mock_get:
-        with mock.patch.object(builtins, "print") as mock_print, pytest.raises(
-            SystemExit
-        ) as pytest_exc:
-            microfs.main(argv=["get"])
-    assert mock_print.call_count == 1
-    assert mock_get.call_count == 0
-    assert pytest_exc.type == SystemExit
+    stdin = io.StringIO("ls\n{} 9600 ls\n".format(option))
+    monkeypatch.setattr("sys.stdin", stdin)
+    with pytest.raises(SystemExit) as pytest_exc:
+        main(argv=["batch"])
+    assert str(mock_print.call_args[0][0]) == (
+        "batch: '{}' can only be given before 'batch'.".format(option)
+    )
+    assert patch_microfs["get_serial"].call_count == 0
+    assert pytest_exc.value.code == 1
+
+
+def test_main_batch_file(tmpdir, mock_serial, patch_microfs, mock_print):
+    """
+    If the batch command is given a path, the commands are read from that
+    file.
+    """
+    path = tmpdir.join("commands.txt")
+    path.write("ls ;\n")
+    patch_microfs["ls"].return_value = ["foo", "bar"]
+    main(argv=["batch", str(path)])
+    patch_microfs["ls"].assert_called_once_with(mock_serial, True)
+    mock_print.assert_called_once_with("foo;bar")
+
+
+def test_main_batch_no_filename(patch_microfs, mock_print, monkeypatch):
+    """
+    If a command in the batch is missing a filename, print an error message
+    before connecting to the device.
+    """
+    stdin = io.StringIO("ls\nrm\n")
+    monkeypatch.setattr("sys.stdin", stdin)
+    with pytest.raises(SystemExit) as pytest_exc:
+        main(argv=["batch"])
+    mock_print.assert_called_once_with(
+        'rm: missing filename. (e.g. "ufs rm foo.txt")'
+    )
+    assert patch_microfs["get_serial"].call_count == 0
     assert pytest_exc.value.code == 2
 
 
-def test_main_handle_exception():
+def test_main_batch_nested(patch_microfs, mock_print, monkeypatch):
     """
-    If an exception is raised, then it gets printed.
+    A batch cannot contain another batch command.
     """
-    ex = ValueError("Error")
-    mock_serial = mock.MagicMock()
-    mock_class = mock.MagicMock()
-    mock_class.__enter__.return_value = mock_serial
-    with mock.patch("microfs.get", side_effect=ex), mock.patch(
-        "microfs.get_serial", return_value=mock_class
-    ), mock.patch.object(builtins, "print") as mock_print, pytest.raises(
-        SystemExit
-    ) as pytest_exc:
-        microfs.main(argv=["get", "foo"])
-    mock_print.assert_called_once_with(ex)
-    assert pytest_exc.type == SystemExit
+    stdin = io.StringIO("batch\n")
+    monkeypatch.setattr("sys.stdin", stdin)
+    with pytest.raises(SystemExit) as pytest_exc:
+        main(argv=["batch"])
+    assert str(mock_print.call_args[0][0]) == "batch: cannot run 'batch'."
+    assert patch_microfs["get_serial"].call_count == 0
     assert pytest_exc.value.code == 1